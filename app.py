@@ -1,10 +1,17 @@
+import asyncio
 import chainlit as cl
-from src.autogen.groupchat import get_groupchat
-from src.vn_utils import vn
+from src.autogen.groupchat import TASK_PREFIX, get_groupchat, set_tool_session, tool_runtime
+from src.autogen.autogen_utils import get_ui_queue
+from src.vn_utils import collect_stream, vn
+from src.tracing import approx_tokens, span
+from src.downsampling import downsample_frame
+from src.artifact_store import artifact_store
 
 import warnings
 warnings.filterwarnings('ignore')
 
+TABLE_ROWS = 20 # rows of a Vanna result shown before the chart is ready
+
 @cl.set_chat_profiles
 async def chat_profile():
     return [
@@ -23,43 +30,71 @@ async def chat_profile():
 
 @cl.step(language="sql", name="Vanna")
 async def gen_query(human_query: str):
-    return vn.generate_sql(human_query)
+    with span("vanna.generate_sql", input_tokens=approx_tokens(human_query)) as stage:
+        sql = await asyncio.to_thread(vn.generate_sql, human_query)
+        stage.set_attribute("output_tokens", approx_tokens(sql))
+        return sql
 
 @cl.step(name="Vanna")
-async def execute_query(query):
+async def execute_query(query, answer: cl.Message):
+    """Runs the query and shows the first rows in ``answer`` as soon as they are read"""
     current_step = cl.context.current_step
-    df = vn.run_sql(query)
+    with span("vanna.run_sql") as stage:
+        chunks = vn.stream_sql(query)
+        first_chunk = await asyncio.to_thread(next, chunks)
+        answer.content = f"{answer.content}\n\n{first_chunk.head(TABLE_ROWS).to_markdown(index=False)}"
+        await answer.send()
+        df = await asyncio.to_thread(collect_stream, chunks) # read the rest
+        stage.set_attributes(rows=len(df), columns=len(df.columns))
+    if df.attrs.get("truncated"):
+        answer.content += f"\n\n*Only the first {len(df):,} rows were loaded.*"
+        await answer.update()
     current_step.output = df.head().to_markdown(index=False)
     return df
 
 @cl.step(name="Plot", language="python")
 async def plot(human_query, sql, df):
     current_step = cl.context.current_step
-    plotly_code = vn.generate_plotly_code(question=human_query,
-                                          sql=sql,
-                                          df=df)
-    fig = vn.get_plotly_figure(plotly_code=plotly_code, df=df, dark_mode=False)
+    with span("vanna.generate_plotly_code") as stage:
+        plotly_code = await asyncio.to_thread(vn.generate_plotly_code,
+                                              question=human_query,
+                                              sql=sql,
+                                              df=df)
+        stage.set_attribute("output_tokens", approx_tokens(plotly_code))
+    with span("vanna.plot", rows=len(df)) as stage:
+        # Long daily histories are thinned to what the chart can show
+        plot_df = downsample_frame(df)
+        stage.set_attribute("plotted_rows", len(plot_df))
+        fig = await asyncio.to_thread(vn.get_plotly_figure, plotly_code=plotly_code, df=plot_df, dark_mode=False)
     current_step.output=plotly_code
     return fig
 
 @cl.step(name="Vanna")
 async def generate_follow_up(human_query, sql, df):
     current_step = cl.context.current_step
-    questions = vn.generate_followup_questions(question = human_query, sql = sql, df = df)
+    with span("vanna.follow_up") as stage:
+        questions = await asyncio.to_thread(vn.generate_followup_questions, question = human_query, sql = sql, df = df)
+        stage.set_attribute("output_tokens", approx_tokens(questions))
     questions = questions[:3]
     current_step.output = ", ".join(questions)
     return questions
 
 @cl.step(type="run", name="Vanna")
 async def chain(human_query: str):
+    with span("vanna.chain", session=cl.context.session.id):
+        await _chain(human_query)
+
+async def _chain(human_query: str):
     sql_query = await gen_query(human_query)
-    df = await execute_query(sql_query)
-    fig = await plot(human_query, sql_query, df)
-    follow_ups = await generate_follow_up(human_query, sql_query, df)
-    elements = [cl.Plotly(name="chart", figure=fig, display="inline")]
-    await cl.Message(content=human_query,
-                     elements=elements,
-                     author="Vanna").send()
+    answer = cl.Message(content=human_query, author="Vanna")
+    df = await execute_query(sql_query, answer)
+    # The chart and the follow-up questions only depend on the query and its
+    # results, so both LLM calls run together while the table is already shown
+    fig, follow_ups = await asyncio.gather(
+        plot(human_query, sql_query, df),
+        generate_follow_up(human_query, sql_query, df),
+    )
+    await cl.Plotly(name="chart", figure=fig, display="inline").send(for_id=answer.id)
     actions = [
         cl.Action(name="question",
                   value=question,
@@ -101,6 +136,17 @@ async def on_chat_start():
         )
     await msg.send()
 
+@cl.on_stop
+async def on_stop():
+    # Chainlit cancels the running conversation; drop its queued tool calls too
+    tool_runtime.cancel_session(cl.context.session.id)
+
+@cl.on_chat_end
+async def on_chat_end():
+    # The user left, possibly while tools were still running for them
+    tool_runtime.cancel_session(cl.context.session.id)
+    artifact_store.clear_session(cl.context.session.id)
+
 @cl.on_message
 async def run_conversation(message: cl.Message):
     chat_profile = cl.user_session.get("chat_profile")
@@ -110,14 +156,20 @@ async def run_conversation(message: cl.Message):
         manager = cl.user_session.get('manager')
         user_proxy = cl.user_session.get('user_proxy')
         groupchat = cl.user_session.get('group_chat')
+        # Tool results are memoized per session as well as across sessions
+        set_tool_session(cl.context.session.id)
 
-        if len(groupchat.messages) == 0:
-            message = f"""Do the task based on the user input: {CONTEXT}."""
-            await cl.Message(content=f"""Starting agents on task...""").send()
-            await cl.make_async(user_proxy.initiate_chat)(manager, message=message)
-        elif len(groupchat.messages) < MAX_ITER:
-            await cl.make_async(user_proxy.send)(manager, message=CONTEXT)
-        elif len(groupchat.messages) == MAX_ITER:  
-            await cl.make_async(user_proxy.send)(manager, message="exit")
+        # The agents run on the event loop via autogen's async API, so sessions
+        # do not each hold a worker thread for the length of the chat
+        with span("groupchat.turn", session=cl.context.session.id, messages=len(groupchat.messages)):
+            if len(groupchat.messages) == 0:
+                message = f"""{TASK_PREFIX}{CONTEXT}."""
+                await cl.Message(content=f"""Starting agents on task...""").send()
+                await user_proxy.a_initiate_chat(manager, message=message)
+            elif len(groupchat.messages) < MAX_ITER:
+                await user_proxy.a_send(message=CONTEXT, recipient=manager)
+            elif len(groupchat.messages) == MAX_ITER:  
+                await user_proxy.a_send(message="exit", recipient=manager)
+            await get_ui_queue().flush()
     else:
         await chain(message.content)
\ No newline at end of file
@@ -0,0 +1,210 @@
+#%%
+"""Recorded and synthetic fixtures that let the tools run without network access.
+
+Price histories and financial statements are loaded from ``fixtures/<TICKER>.pkl``
+when they have been recorded with ``run_benchmarks.py --record``, and generated
+deterministically otherwise. ``offline_yfinance`` patches ``yf.Ticker`` and
+``yf.download`` to serve them.
+"""
+import os
+import zlib
+import pickle
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+TICKERS = ["AAPL", "MSFT", "NVDA"]
+
+PERIODS = {
+    "1d": pd.DateOffset(days=1),
+    "5d": pd.DateOffset(days=5),
+    "1mo": pd.DateOffset(months=1),
+    "3mo": pd.DateOffset(months=3),
+    "6mo": pd.DateOffset(months=6),
+    "1y": pd.DateOffset(years=1),
+    "2y": pd.DateOffset(years=2),
+    "5y": pd.DateOffset(years=5),
+    "10y": pd.DateOffset(years=10),
+}
+
+STATEMENT_ITEMS = {
+    "balancesheet": [
+        "Total Assets", "Current Assets", "Current Liabilities", "Inventory",
+        "Stockholders Equity", "Total Liabilities Net Minority Interest",
+    ],
+    "financials": ["Total Revenue", "Gross Profit", "Net Income", "Basic EPS"],
+    "cashflow": ["Operating Cash Flow", "Capital Expenditure", "Free Cash Flow"],
+}
+
+def _rng(ticker: str) -> np.random.Generator:
+    return np.random.default_rng(zlib.crc32(ticker.encode()))
+
+def synthetic_history(ticker: str, years: int = 12) -> pd.DataFrame:
+    """Daily prices up to today following a seeded geometric random walk,
+    shaped like ``yf.Ticker(ticker).history()``"""
+    rng = _rng(ticker)
+    index = pd.bdate_range(
+        end = pd.Timestamp.today().normalize(), periods = 252 * years
+    ).tz_localize("America/New_York")
+    close = 50 * np.exp(np.cumsum(rng.normal(0.0004, 0.018, len(index))))
+    spread = np.abs(rng.normal(0, 0.01, len(index))) * close
+    return pd.DataFrame({
+        "Open": close + rng.normal(0, 0.005, len(index)) * close,
+        "High": close + spread,
+        "Low": close - spread,
+        "Close": close,
+        "Volume": rng.integers(1_000_000, 50_000_000, len(index)),
+        "Dividends": np.where(np.arange(len(index)) % 63 == 0, 0.2, 0.0),
+        "Stock Splits": 0.0,
+    }, index=pd.DatetimeIndex(index, name="Date"))
+
+def synthetic_statements(ticker: str, history: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Four annual financial statements, shaped like ``yf.Ticker(ticker).balancesheet``
+    (line items as rows, fiscal year ends as columns)"""
+    rng = _rng(ticker + "statements")
+    year_ends = [history.index[history.index.year == year][-1].tz_localize(None).normalize()
+                 for year in sorted(set(history.index.year))[-5:-1]][::-1]
+    statements = {}
+    for name, items in STATEMENT_ITEMS.items():
+        statements[name] = pd.DataFrame(
+            rng.uniform(1e9, 1e11, (len(items), len(year_ends))),
+            index = items,
+            columns = year_ends,
+        )
+    statements["financials"].loc["Basic EPS"] = rng.uniform(1, 10, len(year_ends))
+    statements["actions"] = history.loc[history["Dividends"] > 0, ["Dividends", "Stock Splits"]]
+    return statements
+
+#%%
+class FixtureStore:
+    """Price histories and statements per ticker, recorded or synthetic"""
+
+    def __init__(self, fixture_dir: str = FIXTURE_DIR):
+        self.fixture_dir = fixture_dir
+        self._data: Dict[str, Dict] = {}
+
+    def _path(self, ticker: str) -> str:
+        return os.path.join(self.fixture_dir, f"{ticker.upper()}.pkl")
+
+    def get(self, ticker: str) -> Dict:
+        ticker = ticker.upper()
+        if ticker not in self._data:
+            if os.path.exists(self._path(ticker)):
+                with open(self._path(ticker), "rb") as file:
+                    self._data[ticker] = pickle.load(file)
+            else:
+                history = synthetic_history(ticker)
+                self._data[ticker] = {"history": history, **synthetic_statements(ticker, history)}
+        return self._data[ticker]
+
+    def is_recorded(self, ticker: str) -> bool:
+        return os.path.exists(self._path(ticker))
+
+    def record(self, tickers: List[str] = TICKERS):
+        """Downloads live data from Yahoo Finance and saves it as fixtures"""
+        import yfinance as yf
+        os.makedirs(self.fixture_dir, exist_ok=True)
+        for ticker in tickers:
+            live = yf.Ticker(ticker)
+            data = {
+                "history": live.history(period="max"),
+                "balancesheet": live.balancesheet,
+                "financials": live.financials,
+                "cashflow": live.cashflow,
+                "actions": live.actions,
+            }
+            with open(self._path(ticker), "wb") as file:
+                pickle.dump(data, file)
+            self._data[ticker.upper()] = data
+
+class FixtureTicker:
+    """Serves ``yf.Ticker`` attributes from a FixtureStore"""
+
+    def __init__(self, ticker: str, store: FixtureStore):
+        self.ticker = ticker
+        self._data = store.get(ticker)
+
+    def history(self, period: str = "1mo", **kwargs) -> pd.DataFrame:
+        df = self._data["history"]
+        if period in PERIODS:
+            df = df[df.index > df.index[-1] - PERIODS[period]]
+        elif period == "ytd":
+            df = df[df.index.year == df.index[-1].year]
+        return df.copy()
+
+    @property
+    def balancesheet(self) -> pd.DataFrame:
+        return self._data["balancesheet"].copy()
+
+    @property
+    def financials(self) -> pd.DataFrame:
+        return self._data["financials"].copy()
+
+    @property
+    def cashflow(self) -> pd.DataFrame:
+        return self._data["cashflow"].copy()
+
+    @property
+    def actions(self) -> pd.DataFrame:
+        return self._data["actions"].copy()
+
+def fixture_download(store: FixtureStore, tickers, start: Optional[str] = None,
+                     end: Optional[str] = None, interval: str = "1d", **kwargs) -> pd.DataFrame:
+    """Serves ``yf.download`` from a FixtureStore. Monthly intervals are
+    resampled from the daily history."""
+    tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+    frames = {}
+    for ticker in tickers:
+        df = store.get(ticker)["history"].tz_localize(None)
+        if start:
+            df = df[df.index >= pd.Timestamp(start)]
+        if end:
+            df = df[df.index < pd.Timestamp(end)]
+        if interval == "1mo":
+            df = df.resample("MS").agg({
+                "Open": "first", "High": "max", "Low": "min", "Close": "last", "Volume": "sum",
+            })
+        df = df[["Open", "High", "Low", "Close", "Volume"]].assign(**{"Adj Close": df["Close"]})
+        frames[ticker.upper()] = df
+    if len(frames) == 1:
+        df = next(iter(frames.values()))
+    else:
+        df = pd.concat(frames, axis=1).swaplevel(axis=1).sort_index(axis=1)
+        df.columns.names = ["Price", "Ticker"]
+    df.index.name = "Date"
+    return df
+
+@contextmanager
+def offline_yfinance(store: FixtureStore):
+    """Patches yfinance so that the tools read fixtures instead of Yahoo Finance"""
+    import yfinance as yf
+    original_ticker, original_download = yf.Ticker, yf.download
+    yf.Ticker = lambda ticker, *args, **kwargs: FixtureTicker(ticker, store)
+    yf.download = lambda tickers, *args, **kwargs: fixture_download(store, tickers, *args, **kwargs)
+    try:
+        yield store
+    finally:
+        yf.Ticker, yf.download = original_ticker, original_download
+
+#%%
+def sec_filing_html(fixture_dir: str = FIXTURE_DIR) -> str:
+    """A 10-Q filing page. Uses ``fixtures/sec_filing.html`` if a real filing has
+    been saved there, otherwise generates one of a similar size (~150k words)."""
+    path = os.path.join(fixture_dir, "sec_filing.html")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            return file.read()
+    rng = np.random.default_rng(0)
+    vocabulary = np.array("""revenue net income operating expenses gross margin liquidity
+    capital resources risk factors segment results cash flows share repurchase dividend
+    guidance inventory supply chain foreign exchange interest rate debt covenant goodwill
+    impairment research development services products quarter fiscal year compared
+    increase decrease primarily due to customers demand pricing""".split())
+    paragraphs = [
+        f"<h2>Item {i}</h2><p>" + " ".join(rng.choice(vocabulary, 300)) + ".</p>"
+        for i in range(500)
+    ]
+    return "<html><body>" + "".join(paragraphs) + "</body></html>"
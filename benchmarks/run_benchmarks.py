@@ -0,0 +1,386 @@
+#%%
+"""Offline benchmarks for the agent tools.
+
+Runs the data analysis, technical analysis, fundamental analysis, forecasting
+and SEC tools against recorded or synthetic fixtures, with a mock LLM and
+embedding model, and reports wall time, peak memory and allocations per stage.
+``db_ingestion`` loads a synthetic 500-ticker universe into the prices table.
+
+    python benchmarks/run_benchmarks.py                      # all benchmarks
+    python benchmarks/run_benchmarks.py --only forecaster sec_tool
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<commit>.json
+    python benchmarks/run_benchmarks.py --record             # refresh price fixtures (needs network)
+
+Wall times are the median of ``--repeat`` runs. Memory is measured in one extra
+run under tracemalloc, which would otherwise slow the timed runs down: peak is
+the highest traced memory during the stage, and allocations are the blocks
+allocated during the stage that were still alive at its end.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "src"))
+sys.path.append(os.path.join(ROOT, "tools"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import FixtureStore, TICKERS, offline_yfinance, sec_filing_html
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+def install_fake_llamaindex_config():
+    """Replaces the Bedrock LLM and embedding model with llama-index mocks, so
+    that tools importing ``llamaindex_config`` run offline and without credentials"""
+    from llama_index.core.llms import MockLLM
+    from llama_index.core.embeddings import MockEmbedding
+    from llama_index.core.node_parser import SentenceSplitter
+
+    module = types.ModuleType("llamaindex_config")
+    module.llm = MockLLM(max_tokens=256)
+    module.embed_model = MockEmbedding(embed_dim=256)
+    module.text_splitter = SentenceSplitter(chunk_size=1024, chunk_overlap=20)
+    sys.modules["llamaindex_config"] = module
+
+class Benchmark:
+    """A named sequence of stages. ``setup`` returns a namespace that the stages
+    share, so later stages can use the output of earlier ones."""
+
+    def __init__(self, name: str, setup: Callable[[], Any], stages: List[Tuple[str, Callable[[Any], Any]]]):
+        self.name = name
+        self.setup = setup
+        self.stages = stages
+
+#%%
+def data_analysis_benchmark() -> Benchmark:
+    from data_analysis_tools import DataAnalysisTools
+
+    return Benchmark(
+        name = "data_analysis_tools",
+        setup = lambda: types.SimpleNamespace(da=DataAnalysisTools()),
+        stages = [
+            ("get_stock_data", lambda ctx: ctx.da.get_stock_data("AAPL", "10y")),
+            ("get_min_or_max", lambda ctx: ctx.da.get_min_or_max("AAPL", "Close", "10y")),
+            ("get_correlation_between_tickers", lambda ctx: ctx.da.get_correlation_between_tickers(TICKERS, "10y")),
+            ("get_rolling_average", lambda ctx: ctx.da.get_rolling_average("AAPL", "Close", 30, "10y")),
+            ("get_rolling_average_correl", lambda ctx: ctx.da.get_rolling_average_correl(TICKERS, "Close", 30, "10y")),
+            ("get_longest_uptrend", lambda ctx: ctx.da.get_longest_uptrend("AAPL")),
+            ("get_longest_downtrend", lambda ctx: ctx.da.get_longest_downtrend("AAPL")),
+            ("cagr", lambda ctx: ctx.da.cagr("AAPL", "10y")),
+            ("get_statistics", lambda ctx: ctx.da.get_statistics("AAPL", "10y")),
+            ("get_statistics_by_quarter", lambda ctx: ctx.da.get_statistics("AAPL", "10y", "quarter")),
+        ],
+    )
+
+def technical_analysis_benchmark() -> Benchmark:
+    from technical_analysis_tools import TechnicalAnalyst
+
+    def get_stock_data(ctx):
+        ctx.df = ctx.ta.get_stock_data("AAPL", "10y")
+
+    def indicator(method: str):
+        return lambda ctx: getattr(ctx.ta, method)(df=ctx.df.copy())
+
+    return Benchmark(
+        name = "technical_analysis",
+        setup = lambda: types.SimpleNamespace(ta=TechnicalAnalyst()),
+        stages = [
+            ("get_stock_data", get_stock_data),
+            ("accumulation_distribution", indicator("get_AccDistIndex")),
+            ("aroon", indicator("get_aroon_indicator")),
+            ("bollinger_bands", indicator("get_bollinger_bands")),
+            ("ichimoku", indicator("get_ichimoku_indicator")),
+            ("macd", indicator("get_macd")),
+            ("stochastic_oscillator", indicator("get_stoch_oscillator")),
+            ("stochastic_rsi", indicator("get_stoch_rsi")),
+            ("analyse", lambda ctx: ctx.ta.analyse("AAPL", "10y")),
+        ],
+    )
+
+def fundamental_analysis_benchmark() -> Benchmark:
+    from fundamental_analysis_tools import FundamentalAnalyst, evaluate_fundamentals
+
+    def load_statements(ctx):
+        ctx.fa = FundamentalAnalyst(ticker="AAPL")
+
+    return Benchmark(
+        name = "fundamental_analysis",
+        setup = types.SimpleNamespace,
+        stages = [
+            ("load_statements", load_statements),
+            ("compute_ratios", lambda ctx: ctx.fa.analyse()),
+            ("evaluate_fundamentals", lambda ctx: evaluate_fundamentals("AAPL")),
+        ],
+    )
+
+def forecaster_benchmark() -> Benchmark:
+    from forecaster import Forecaster
+
+    return Benchmark(
+        name = "forecaster",
+        setup = lambda: types.SimpleNamespace(forecaster=Forecaster()),
+        stages = [
+            ("prepare_and_cross_validate", lambda ctx: ctx.forecaster.post__init__(tickers=TICKERS, h=3)),
+            ("evaluate", lambda ctx: ctx.forecaster.evaluate()),
+            ("forecast", lambda ctx: ctx.forecaster.forecast(h=3, levels=[80, 95])),
+            ("forecast_ticker", lambda ctx: ctx.forecaster.forecast_ticker()),
+            ("end_to_end", lambda ctx: Forecaster()(tickers=TICKERS)),
+        ],
+    )
+
+class _TopNPostprocessor:
+    """Stands in for the Cohere reranker and the LongLLMLingua compressor,
+    which need network access and a GPT-2 download"""
+
+    def __init__(self, top_n: Optional[int] = None):
+        self.top_n = top_n
+
+    def postprocess_nodes(self, nodes, query_str: str):
+        nodes = sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)
+        return nodes[:self.top_n] if self.top_n else nodes
+
+def sec_tool_benchmark() -> Benchmark:
+    from sec_tools import SECTool
+
+    html = sec_filing_html()
+    url = "https://www.sec.gov/fixture-10q.htm"
+    question = "What were the main drivers of gross margin this quarter?"
+
+    def setup():
+        tool = SECTool.__new__(SECTool)
+        tool.device = "cpu"
+        tool.reranker = _TopNPostprocessor(top_n=4)
+        tool.prompt_compressor = _TopNPostprocessor()
+        tool._download_form_html = lambda url: html
+        return types.SimpleNamespace(tool=tool)
+
+    def index(ctx):
+        ctx.retriever = ctx.tool.get_retriever_from_url(url=url)
+
+    def retrieve(ctx):
+        ctx.nodes = ctx.retriever.retrieve(question)
+
+    def rerank(ctx):
+        ctx.reranked = ctx.tool.reranker.postprocess_nodes(nodes=ctx.nodes, query_str=question)
+
+    return Benchmark(
+        name = "sec_tool",
+        setup = setup,
+        stages = [
+            ("download_parse_and_index", index),
+            ("retrieve", retrieve),
+            ("rerank", rerank),
+            ("compress", lambda ctx: ctx.tool.prompt_compressor.postprocess_nodes(nodes=ctx.reranked, query_str=question)),
+            ("return_contexts", lambda ctx: ctx.tool.return_contexts(url=url, question=question)),
+        ],
+    )
+
+def db_ingestion_benchmark(n_tickers: int = 500, years: int = 2) -> Benchmark:
+    """Loads a universe of tickers into the prices table, then replays a nightly
+    update that re-fetches each ticker's last week, refreshing the analytics
+    tables after each. ``per_ticker_to_sql`` is the old path (one table and
+    connection per ticker, default journaling) for comparison, and the
+    ``query_*`` stages compare a 200-day moving average computed with window
+    functions against reading it from the materialized table."""
+    import sqlite3
+    import tempfile
+    import pandas as pd
+    from fixtures import synthetic_history
+    from db_utils import connect_db, normalize_prices, upsert_prices
+    from analytics_tables import refresh_analytics
+
+    tickers = [f"T{i:03d}" for i in range(n_tickers)]
+    histories = {ticker: synthetic_history(ticker, years=years).tz_localize(None) for ticker in tickers}
+    universe = pd.concat(
+        [normalize_prices(ticker, history) for ticker, history in histories.items()], ignore_index=True
+    )
+    nightly = universe[universe["date"] >= sorted(universe["date"].unique())[-5]]
+
+    def setup():
+        directory = tempfile.mkdtemp(prefix="prices-")
+        return types.SimpleNamespace(
+            db_path = os.path.join(directory, "stocks.db"),
+            legacy_db_path = os.path.join(directory, "legacy.db"),
+        )
+
+    def initial_load(ctx):
+        conn = connect_db(ctx.db_path)
+        upsert_prices(conn, universe)
+        conn.close()
+
+    def nightly_update(ctx):
+        conn = connect_db(ctx.db_path)
+        upsert_prices(conn, nightly)
+        conn.close()
+
+    def refresh(ctx):
+        conn = connect_db(ctx.db_path)
+        refresh_analytics(conn)
+        conn.close()
+
+    def query_window_functions(ctx):
+        conn = connect_db(ctx.db_path)
+        conn.execute("""
+            SELECT date, AVG(adj_close) OVER (ORDER BY date ROWS 199 PRECEDING)
+            FROM prices WHERE ticker = 'T042'
+        """).fetchall()
+        conn.close()
+
+    def query_materialized(ctx):
+        conn = connect_db(ctx.db_path)
+        conn.execute("SELECT date, ma_200 FROM daily_metrics WHERE ticker = 'T042'").fetchall()
+        conn.close()
+
+    def per_ticker_to_sql(ctx):
+        for ticker, history in histories.items():
+            conn = sqlite3.connect(ctx.legacy_db_path)
+            history.reset_index().to_sql(ticker, conn, index=False, if_exists="append")
+            conn.close()
+
+    return Benchmark(
+        name = "db_ingestion",
+        setup = setup,
+        stages = [
+            ("upsert_universe", initial_load),
+            ("refresh_analytics_full", refresh),
+            ("upsert_nightly_overlap", nightly_update),
+            ("refresh_analytics_nightly", refresh),
+            ("query_window_functions", query_window_functions),
+            ("query_materialized", query_materialized),
+            ("per_ticker_to_sql", per_ticker_to_sql),
+        ],
+    )
+
+BENCHMARKS = {
+    "data_analysis_tools": data_analysis_benchmark,
+    "technical_analysis": technical_analysis_benchmark,
+    "fundamental_analysis": fundamental_analysis_benchmark,
+    "forecaster": forecaster_benchmark,
+    "sec_tool": sec_tool_benchmark,
+    "db_ingestion": db_ingestion_benchmark,
+}
+
+#%%
+def _measure_memory(fn: Callable[[], Any]) -> Dict[str, float]:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = snapshot.statistics("filename")
+    return {
+        "peak_memory_mb": round(peak / 2**20, 3),
+        "allocated_blocks": sum(stat.count for stat in stats),
+        "allocated_mb": round(sum(stat.size for stat in stats) / 2**20, 3),
+    }
+
+def run_benchmark(benchmark: Benchmark, repeat: int = 3) -> Dict[str, Any]:
+    timings: Dict[str, List[float]] = {name: [] for name, _ in benchmark.stages}
+    for _ in range(repeat):
+        ctx = benchmark.setup()
+        for name, stage in benchmark.stages:
+            start = time.perf_counter()
+            stage(ctx)
+            timings[name].append(time.perf_counter() - start)
+
+    ctx = benchmark.setup()
+    stages = {}
+    for name, stage in benchmark.stages:
+        stages[name] = {
+            "wall_time_s": round(statistics.median(timings[name]), 6),
+            "runs_s": [round(t, 6) for t in timings[name]],
+            **_measure_memory(lambda: stage(ctx)),
+        }
+    return {
+        "total_wall_time_s": round(sum(s["wall_time_s"] for s in stages.values()), 6),
+        "stages": stages,
+    }
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(names: List[str], repeat: int, store: FixtureStore) -> Dict[str, Any]:
+    results = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "fixtures": {ticker: "recorded" if store.is_recorded(ticker) else "synthetic" for ticker in TICKERS},
+        "benchmarks": {},
+    }
+    with offline_yfinance(store):
+        for name in names:
+            print(f"Running {name}...", flush=True)
+            try:
+                results["benchmarks"][name] = run_benchmark(BENCHMARKS[name](), repeat=repeat)
+            except Exception as e:
+                # e.g. an optional dependency of one tool is missing
+                print(f"  failed: {e!r}", flush=True)
+                results["benchmarks"][name] = {"error": repr(e)}
+    return results
+
+def print_report(results: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    print(f"\nCommit {results['commit']}" + (f" vs {baseline['commit']}" if baseline else ""))
+    for name, result in results["benchmarks"].items():
+        print(f"\n{name}")
+        if "error" in result:
+            print(f"  error: {result['error']}")
+            continue
+        old_stages = (baseline or {}).get("benchmarks", {}).get(name, {}).get("stages", {})
+        for stage, values in result["stages"].items():
+            line = (f"  {stage:<34}{values['wall_time_s'] * 1000:>10.1f} ms"
+                    f"{values['peak_memory_mb']:>10.1f} MB peak{values['allocated_blocks']:>10} blocks")
+            if stage in old_stages and old_stages[stage]["wall_time_s"]:
+                line += f"{values['wall_time_s'] / old_stages[stage]['wall_time_s']:>8.2f}x"
+            print(line)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Results file. Defaults to results/<commit>.json")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--record", action="store_true", help="Record price fixtures from Yahoo Finance first")
+    args = parser.parse_args(argv)
+
+    install_fake_llamaindex_config()
+    store = FixtureStore()
+    if args.record:
+        store.record()
+
+    results = run(args.only, args.repeat, store)
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(results, baseline)
+    print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
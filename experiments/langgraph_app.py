@@ -27,6 +27,7 @@ from langgraph.graph import END, StateGraph, START
 _ = load_dotenv(find_dotenv())
 __curdir__ = os.getcwd()
 sys.path.append("../tools")
+sys.path.append("..")
 
 from fundamental_analysis_tools import FundamentalAnalyst
 from technical_analysis_tools import TechnicalAnalyst
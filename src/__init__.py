@@ -0,0 +1,37 @@
+"""Modules in src import each other by their bare names (``from tracing import
+span``) with src on ``sys.path``. ``src.<module>`` is an alias of the bare
+module rather than a second copy of it, so state such as the tracer, the
+artifact store and the tool session exists once, whichever name it is
+imported under."""
+import os
+import sys
+import importlib
+import importlib.abc
+import importlib.util
+
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+if _SRC_DIR not in sys.path:
+    sys.path.append(_SRC_DIR)
+
+class _BareModuleAlias(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Imports ``src.<module>`` as the bare ``<module>``"""
+
+    def __init__(self):
+        self._original_specs = {}
+
+    def find_spec(self, fullname, path, target=None):
+        package, _, name = fullname.rpartition(".")
+        if package != __name__ or not os.path.isfile(os.path.join(_SRC_DIR, name + ".py")):
+            return None
+        return importlib.util.spec_from_loader(fullname, self)
+
+    def create_module(self, spec):
+        module = importlib.import_module(spec.name.rpartition(".")[2])
+        self._original_specs[spec.name] = module.__spec__
+        return module
+
+    def exec_module(self, module):
+        # The import system pointed __spec__ at the alias; the module keeps its own
+        module.__spec__ = self._original_specs.pop(module.__spec__.name)
+
+sys.meta_path.insert(0, _BareModuleAlias())
@@ -0,0 +1,73 @@
+#%%
+import hashlib
+from typing import Any, Dict, Optional
+
+from cache_utils import TTLCache, register_cache
+from tool_cache import get_tool_session
+
+class ArtifactStore:
+    """Holds large outputs (tool results, long agent messages) outside of the
+    conversation. Messages carry a short reference to the artifact instead of
+    the full content, which can be fetched again by id when needed.
+
+    Artifacts belong to the chat session they were stored in (see
+    ``tool_cache.set_tool_session``): a session can only read its own, and
+    ``clear_session`` drops them when the chat ends.
+
+    Args:
+        max_size: artifacts kept per session
+        max_sessions: sessions kept, least recently used ones are dropped first
+        ttl: seconds an artifact is kept
+    """
+
+    def __init__(self, max_size: int = 512, max_sessions: int = 64, ttl: Optional[float] = 24 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions = TTLCache(max_size=max_sessions, ttl=None)
+        register_cache("artifacts", self)
+
+    def _session_store(self, create: bool) -> Optional[TTLCache]:
+        session_id = get_tool_session()
+        store = self._sessions.get(session_id)
+        if store is None and create:
+            store = TTLCache(max_size=self.max_size, ttl=self.ttl)
+            self._sessions.set(session_id, store)
+        return store
+
+    def put(self, content: Any, key: Optional[str] = None) -> str:
+        """Stores content and returns its artifact id. Identical content shares an id."""
+        artifact_id = hashlib.sha1((key or str(content)).encode()).hexdigest()[:12]
+        self._session_store(create=True).set(artifact_id, content)
+        return artifact_id
+
+    def get(self, artifact_id: str) -> Optional[Any]:
+        store = self._session_store(create=False)
+        return store.get(artifact_id.strip().strip("'\"")) if store is not None else None
+
+    def __contains__(self, artifact_id: str) -> bool:
+        store = self._session_store(create=False)
+        return store is not None and artifact_id in store
+
+    def clear_session(self, session_id: Optional[str]):
+        """Drops the artifacts of a chat session"""
+        self._sessions.pop(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        stores = [store for _, store in self._sessions.items()]
+        hits = sum(store.hits for store in stores)
+        misses = sum(store.misses for store in stores)
+        return {
+            "size": sum(len(store) for store in stores),
+            "sessions": len(stores),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        }
+
+    @staticmethod
+    def reference(artifact_id: str, description: str) -> str:
+        """The text that stands in for an artifact inside a message"""
+        return f"[artifact '{artifact_id}': {description}]"
+
+## One store per process, with the artifacts of each chat session kept apart
+artifact_store = ArtifactStore()
@@ -1,15 +1,17 @@
 
+import re
 import requests
-from typing import List, Optional, Literal
+from typing import List, Optional, Literal, Tuple
 
 from llama_index.core import Document
 from llama_index.core.tools.tool_spec.base import BaseToolSpec
 from llama_index.core.agent import (
     FunctionCallingAgentWorker,
     AgentRunner,
-    ReActAgent,
+    ReActAgentWorker,
     StructuredPlannerAgent
 )
+from llama_index.core.memory import ChatMemoryBuffer
 from autogen.agentchat.contrib.llamaindex_conversable_agent import (
     LLamaIndexConversableAgent
 )
@@ -19,10 +21,18 @@ from autogen import (
     Agent
 )
 import chainlit as cl
-from typing import Union, Optional, Dict 
+from typing import Any, Union, Optional, Dict 
+import asyncio
+import logging
 import warnings
 
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracing import approx_tokens, message_text, span
+
 warnings.filterwarnings("ignore")
+logger = logging.getLogger(__name__)
 
 # def chat_new_message(message, sender):
 #     cl.run_sync(
@@ -45,6 +55,74 @@ async def ask_helper(func, **kwargs):
         res = await func(**kwargs).send()
     return res
 
+class UIMessageQueue:
+    """Posts agent messages to the Chainlit UI without blocking the agents.
+    Messages are queued and sent in order by one background task per session,
+    which inherits the session's Chainlit context. A message that fails to send
+    is logged and skipped, so the messages after it still go out."""
+    
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._task = None
+    
+    def post(self, content: str, author: str):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._drain())
+        self._queue.put_nowait((content, author))
+    
+    async def _drain(self):
+        while True:
+            content, author = await self._queue.get()
+            try:
+                await cl.Message(content=content, author=author).send()
+            except Exception:
+                logger.exception("Could not post the message of %s to the UI", author)
+            finally:
+                self._queue.task_done()
+    
+    async def flush(self):
+        """Waits until every queued message has been sent"""
+        await self._queue.join()
+
+def get_ui_queue() -> UIMessageQueue:
+    """Returns the UI message queue of the current Chainlit session"""
+    queue = cl.user_session.get("ui_queue")
+    if queue is None:
+        queue = UIMessageQueue()
+        cl.user_session.set("ui_queue", queue)
+    return queue
+
+class TracedRepliesMixin:
+    """Wraps each reply an agent generates in an ``agent.reply`` span, so tool
+    calls and LLM work done for the reply are nested under it"""
+
+    @staticmethod
+    def _reply_tokens(reply: Union[str, Dict, None]) -> int:
+        return approx_tokens(reply.get("content") if isinstance(reply, dict) else reply)
+
+    def _reply_span(self, messages: Optional[List[Dict]], sender: Optional[Agent]):
+        if messages is None and sender is not None:
+            messages = self.chat_messages.get(sender, [])
+        return span(
+            "agent.reply",
+            agent = self.name,
+            sender = sender.name if sender else "",
+            messages = len(messages or []),
+            input_tokens = sum(approx_tokens(message_text(m)) for m in messages or []),
+        )
+
+    def generate_reply(self, messages: Optional[List[Dict]] = None, sender: Optional[Agent] = None, **kwargs):
+        with self._reply_span(messages, sender) as reply_span:
+            reply = super().generate_reply(messages=messages, sender=sender, **kwargs)
+            reply_span.set_attribute("output_tokens", self._reply_tokens(reply))
+            return reply
+
+    async def a_generate_reply(self, messages: Optional[List[Dict]] = None, sender: Optional[Agent] = None, **kwargs):
+        with self._reply_span(messages, sender) as reply_span:
+            reply = await super().a_generate_reply(messages=messages, sender=sender, **kwargs)
+            reply_span.set_attribute("output_tokens", self._reply_tokens(reply))
+            return reply
+
 class ChainlitConversableAgent(ConversableAgent):
     def send(
         self,
@@ -68,7 +146,70 @@ class ChainlitConversableAgent(ConversableAgent):
             silent=silent,
         )
 
-class ChainlitLLamaIndexConversableAgent(LLamaIndexConversableAgent):
+    async def a_send(
+        self,
+        message: Union[Dict, str],
+        recipient: Agent,
+        request_reply: Optional[bool] = None,
+        silent: Optional[bool] = False,
+    ):
+        if isinstance(message, dict):
+            message = message['content']
+        get_ui_queue().post(
+            content = f"{self.name} *Sending message to '{recipient.name}':*\n\n{message}",
+            author = self.name,
+        )
+        await super(ChainlitConversableAgent, self).a_send(
+            message=message,
+            recipient=recipient,
+            request_reply=request_reply,
+            silent=silent,
+        )
+
+class ChainlitLLamaIndexConversableAgent(TracedRepliesMixin, LLamaIndexConversableAgent):
+    def __init__(self, *args, stream: bool = False, **kwargs):
+        """When ``stream`` is set, replies from the async chat path are streamed
+        token by token into the Chainlit UI as they are generated"""
+        super().__init__(*args, **kwargs)
+        self.stream = stream
+        self._streamed_reply = None
+        self.replace_reply_func(
+            LLamaIndexConversableAgent._a_generate_oai_reply,
+            ChainlitLLamaIndexConversableAgent._a_generate_streaming_reply
+        )
+    
+    async def _a_generate_streaming_reply(
+        self,
+        messages: Optional[List[Dict]] = None,
+        sender: Optional[Agent] = None,
+        config: Optional[Any] = None,
+    ):
+        """Pipes the llama-index agent's astream_chat output into a Chainlit
+        message. Falls back to a plain achat for agents that cannot stream."""
+        if not self.stream:
+            return await self._a_generate_oai_reply(messages=messages, sender=sender, config=config)
+        user_message, history = self._extract_message_and_history(messages=messages, sender=sender)
+        try:
+            response = await self._llama_index_agent.astream_chat(
+                message=user_message, chat_history=history
+            )
+        except NotImplementedError:
+            return await self._a_generate_oai_reply(messages=messages, sender=sender, config=config)
+        
+        await get_ui_queue().flush()
+        msg = cl.Message(
+            content = f"{self.name} *Sending message to '{sender.name}':*\n\n",
+            author = self.name,
+        )
+        tokens = []
+        async for token in response.async_response_gen():
+            tokens.append(token)
+            await msg.stream_token(token)
+        await msg.send()
+        reply = "".join(tokens)
+        self._streamed_reply = reply
+        return True, reply
+    
     def send(
         self,
         message: Union[Dict, str],
@@ -91,38 +232,63 @@ class ChainlitLLamaIndexConversableAgent(LLamaIndexConversableAgent):
             silent=silent,
         )
 
+    async def a_send(
+        self,
+        message: Union[Dict, str],
+        recipient: Agent,
+        request_reply: Optional[bool] = None,
+        silent: Optional[bool] = False,
+    ):
+        if isinstance(message, dict):
+            message = message['content']
+        streamed_reply, self._streamed_reply = self._streamed_reply, None
+        if message != streamed_reply: # streamed replies are already on screen
+            get_ui_queue().post(
+                content = f"{self.name} *Sending message to '{recipient.name}':*\n\n{message}",
+                author = self.name,
+            )
+        await super(ChainlitLLamaIndexConversableAgent, self).a_send(
+            message=message,
+            recipient=recipient,
+            request_reply=request_reply,
+            silent=silent,
+        )
+
 class ChainlitUserProxyAgent(UserProxyAgent):
     def get_human_input(self, prompt: str) -> str:
+        return cl.run_sync(self.a_get_human_input(prompt))
+    
+    async def a_get_human_input(self, prompt: str) -> str:
+        # Show every pending agent message before asking the user
+        await get_ui_queue().flush()
         if prompt.startswith(
             "Provide feedback to chat_manager. Press enter to skip and use auto-reply"
         ):
-            res = cl.run_sync(
-                ask_helper(
-                    cl.AskActionMessage,
-                    content="Continue or provide feedback?",
-                    actions=[
-                        cl.Action(
-                            name="continue", value="continue", label="✅ Continue"
-                        ),
-                        cl.Action(
-                            name="feedback",
-                            value="feedback",
-                            label="💬 Provide feedback",
-                        ),
-                        cl.Action( 
-                            name="exit",
-                            value="exit", 
-                            label="🔚 Exit Conversation" 
-                        ),
-                    ],
-                )
+            res = await ask_helper(
+                cl.AskActionMessage,
+                content="Continue or provide feedback?",
+                actions=[
+                    cl.Action(
+                        name="continue", value="continue", label="✅ Continue"
+                    ),
+                    cl.Action(
+                        name="feedback",
+                        value="feedback",
+                        label="💬 Provide feedback",
+                    ),
+                    cl.Action( 
+                        name="exit",
+                        value="exit", 
+                        label="🔚 Exit Conversation" 
+                    ),
+                ],
             )
             if res.get("value") == "continue":
                 return ""
             if res.get("value") == "exit":
                 return "exit"
 
-        reply = cl.run_sync(ask_helper(cl.AskUserMessage, content=prompt, timeout=60))
+        reply = await ask_helper(cl.AskUserMessage, content=prompt, timeout=60)
         return reply["output"].strip()
 
     def send(
@@ -147,6 +313,211 @@ class ChainlitUserProxyAgent(UserProxyAgent):
             silent=silent,
         )
 
+    async def a_send(
+        self,
+        message: Union[Dict, str],
+        recipient: Agent,
+        request_reply: Optional[bool] = None,
+        silent: Optional[bool] = False,
+    ):
+        if isinstance(message, dict):
+            message = message['content']
+        get_ui_queue().post(
+            content = f'*Sending message to "{recipient.name}"*:\n\n{message}',
+            author = "UserProxyAgent",
+        )
+        await super(ChainlitUserProxyAgent, self).a_send(
+            message=message,
+            recipient=recipient,
+            request_reply=request_reply,
+            silent=silent,
+        )
+
+class ChainlitFanOutAgent(TracedRepliesMixin, ChainlitConversableAgent):
+    """Runs independent agents concurrently on the same request and replies with
+    their combined answers, so a turn takes as long as the slowest agent instead
+    of the sum of all of them. Each answer is shown in the UI as soon as it is ready.
+
+    Args:
+        members: agents that always answer the request
+        optional_members: agents that only answer if the request matches their regex
+    """
+
+    def __init__(self,
+                 name: str,
+                 members: List[Agent],
+                 description: str,
+                 optional_members: Optional[Dict[Agent, str]] = None,
+                 **kwargs):
+        super().__init__(
+            name = name,
+            description = description,
+            llm_config = False,
+            code_execution_config = False,
+            human_input_mode = "NEVER",
+            **kwargs
+        )
+        self.members = members
+        self.optional_members = {
+            agent: re.compile(pattern, re.IGNORECASE)
+            for agent, pattern in (optional_members or {}).items()
+        }
+        self._fanned_out_reply = None
+        self.register_reply([Agent, None], ChainlitFanOutAgent._generate_fan_out_reply)
+        self.register_reply(
+            [Agent, None],
+            ChainlitFanOutAgent._a_generate_fan_out_reply,
+            ignore_async_in_sync_chat = True
+        )
+
+    def _select_members(self, messages: List[Dict]) -> List[Agent]:
+        request = str(messages[-1].get("content") or "") if messages else ""
+        return self.members + [
+            agent for agent, pattern in self.optional_members.items()
+            if pattern.search(request)
+        ]
+
+    @staticmethod
+    def _combine(replies: List[Tuple[Agent, str]]) -> str:
+        return "\n\n".join(f"### {agent.name}\n\n{reply}" for agent, reply in replies)
+
+    def _generate_fan_out_reply(
+        self,
+        messages: Optional[List[Dict]] = None,
+        sender: Optional[Agent] = None,
+        config: Optional[Any] = None,
+    ):
+        """Sync chats have no event loop to fan out on, so members answer in turn"""
+        messages = messages or self._oai_messages[sender]
+        replies = []
+        for agent in self._select_members(messages):
+            reply = agent.generate_reply(messages=messages, sender=sender)
+            replies.append((agent, reply["content"] if isinstance(reply, dict) else reply))
+        return True, self._combine(replies)
+
+    async def _a_generate_fan_out_reply(
+        self,
+        messages: Optional[List[Dict]] = None,
+        sender: Optional[Agent] = None,
+        config: Optional[Any] = None,
+    ):
+        messages = messages or self._oai_messages[sender]
+        members = self._select_members(messages)
+
+        async def answer(agent: Agent):
+            try:
+                reply = await agent.a_generate_reply(messages=messages, sender=sender)
+            except Exception as e:
+                reply = f"{agent.name} could not complete the analysis: {e}"
+            if isinstance(reply, dict):
+                reply = reply["content"]
+            # Agents that streamed their reply have already put it on screen
+            if getattr(agent, "_streamed_reply", None) == reply:
+                agent._streamed_reply = None
+            else:
+                get_ui_queue().post(
+                    content = f"{agent.name} *Sending message to '{sender.name}':*\n\n{reply}",
+                    author = agent.name,
+                )
+            return agent, reply
+
+        replies = await asyncio.gather(*(answer(agent) for agent in members))
+        self._fanned_out_reply = self._combine(replies)
+        return True, self._fanned_out_reply
+
+    async def a_send(
+        self,
+        message: Union[Dict, str],
+        recipient: Agent,
+        request_reply: Optional[bool] = None,
+        silent: Optional[bool] = False,
+    ):
+        if isinstance(message, dict):
+            message = message['content']
+        fanned_out_reply, self._fanned_out_reply = self._fanned_out_reply, None
+        if message == fanned_out_reply: # each member's answer is already on screen
+            await super(ChainlitConversableAgent, self).a_send(
+                message=message,
+                recipient=recipient,
+                request_reply=request_reply,
+                silent=silent,
+            )
+        else:
+            await super().a_send(
+                message=message,
+                recipient=recipient,
+                request_reply=request_reply,
+                silent=silent,
+            )
+
+class AgentTemplate:
+    """The stateless part of an agent: its tools, llm and llama-index agent worker.
+    Templates are built once per process; ``clone`` wraps the shared worker in a
+    fresh AgentRunner and autogen agent so each session only pays for its own
+    memory and message history."""
+    
+    def __init__(self,
+                 llm,
+                 tools: List[BaseToolSpec],
+                 agent_name: str,
+                 agent_description: str,
+                 system_message: Optional[str] = None,
+                 human_input_mode: Optional[str] = "NEVER",
+                 agent_type: Optional[Literal[
+                     "function",
+                     "react",
+                     "structured"
+                 ]] = "function",
+                 stream: Optional[bool] = None,
+                 ):
+        self.llm = llm
+        self.tools = tools
+        self.agent_name = agent_name
+        self.agent_description = agent_description
+        self.system_message = system_message
+        self.human_input_mode = human_input_mode
+        self.agent_type = agent_type
+        # Only ReAct workers support streaming in llama-index
+        self.stream = agent_type == "react" if stream is None else stream
+        if agent_type == "react":
+            self.agent_worker = ReActAgentWorker.from_tools(
+                tools,
+                llm = llm,
+                verbose = True,
+            )
+        else:
+            self.agent_worker = FunctionCallingAgentWorker.from_tools(
+                tools = tools,
+                llm = llm,
+                verbose = True
+            )
+    
+    def get_llama_index_agent(self):
+        """Returns a new llama-index agent around the shared worker"""
+        if self.agent_type == "structured":
+            return StructuredPlannerAgent(
+                agent_worker = self.agent_worker,
+                tools = self.tools,
+                verbose = True,
+            )
+        return AgentRunner(
+            self.agent_worker,
+            memory = ChatMemoryBuffer.from_defaults(llm=self.llm),
+            verbose = self.agent_type == "react",
+        )
+    
+    def clone(self) -> ChainlitLLamaIndexConversableAgent:
+        """Returns a per-session agent"""
+        return ChainlitLLamaIndexConversableAgent(
+            name = self.agent_name,
+            llama_index_agent = self.get_llama_index_agent(),
+            system_message = self.system_message,
+            description = self.agent_description,
+            human_input_mode = self.human_input_mode,
+            max_consecutive_auto_reply = 10,
+            stream = self.stream,
+        )
+
 def get_agent(llm,
               tools: List[BaseToolSpec],
               agent_name: str,
@@ -159,44 +530,12 @@ def get_agent(llm,
                   "structured"
               ]] = "function"
               ):
-    if agent_type == "react":
-        return ChainlitLLamaIndexConversableAgent(
-            name = agent_name,
-            llama_index_agent = ReActAgent.from_tools(
-                tools,
-                llm = llm,
-                verbose = True,
-            ),
-            system_message = system_message,
-            description = agent_description,
-            human_input_mode = human_input_mode,
-            max_consecutive_auto_reply = 10,
-        )
-    else:
-        agent_worker = FunctionCallingAgentWorker.from_tools(
-            tools = tools,
-            llm = llm,
-            verbose = True
-        )
-        if agent_type == "structured":
-            return ChainlitLLamaIndexConversableAgent(
-                name = agent_name,
-                llama_index_agent = StructuredPlannerAgent(
-                    agent_worker = agent_worker,
-                    tools = tools,
-                    verbose = True,
-                ),
-                system_message = system_message,
-                description = agent_description,
-                human_input_mode = human_input_mode,
-                max_consecutive_auto_reply = 10,
-            )
-        return ChainlitLLamaIndexConversableAgent(
-            name = agent_name,
-            llama_index_agent = agent_worker.as_agent(),
-            system_message = system_message,
-            description = agent_description,
-            human_input_mode = human_input_mode,
-            max_consecutive_auto_reply = 10,
-        )
-    
\ No newline at end of file
+    return AgentTemplate(
+        llm = llm,
+        tools = tools,
+        agent_name = agent_name,
+        agent_description = agent_description,
+        system_message = system_message,
+        human_input_mode = human_input_mode,
+        agent_type = agent_type,
+    ).clone()
@@ -1,25 +1,26 @@
 #%%
-from .autogen_utils import get_agent, ChainlitUserProxyAgent
+from .autogen_utils import AgentTemplate, ChainlitFanOutAgent, ChainlitUserProxyAgent
+from .history import CompactingGroupChat, HistoryCompactor
+from .speaker_selection import SpeakerRoute, SpeakerSelector
+from .tool_registry import ToolRegistry
 
 import os
+import re
 import sys
+import logging
+import threading
 
 __curdir__ = os.getcwd()
 if "src" in __curdir__:
     sys.path.append("../tools")
 else:
     sys.path.append("./tools")
-    
-from calculator_tools import get_calculator_tool
-from data_analysis_tools import get_da_tools
-from fundamental_analysis_tools import get_fa_tools
-from rag_tools import get_rag_tools
-from search_tools import get_tavily_tool
-from sec_tools import get_sec_tool
-from technical_analysis_tools import get_ta_tools  
-from gmail_tool import get_gmail_tool
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tool_cache import set_tool_session
+from tool_runtime import ToolRuntime
 
 import autogen
+from autogen.agentchat.contrib.capabilities.transform_messages import TransformMessages
 
 from llama_index.core import Settings
 from llama_index.llms.bedrock_converse import BedrockConverse
@@ -37,6 +38,9 @@ from llama_index.embeddings.bedrock import BedrockEmbedding
 
 # llm_config={"config_list": llm_config_list, "seed": seed}
 
+## The first message of a chat is the user's input behind this prefix
+TASK_PREFIX = "Do the task based on the user input: "
+
 llm_config = {
     "model": os.environ["AZURE_OPENAI_GPT4O_DEPLOYMENT_NAME"],
     "api_key": os.environ["AZURE_OPENAI_API_KEY"],
@@ -45,14 +49,36 @@ llm_config = {
     "api_version": os.environ["AZURE_API_VERSION"]
 }
 
-calculator_tool = get_calculator_tool()
-da_tool = get_da_tools()
-fa_tool = get_fa_tools()
-textbook_tool = get_rag_tools()
-search_tool = get_tavily_tool()
-sec_tool = get_sec_tool()
-ta_tool = get_ta_tools()
-gmail_tool = get_gmail_tool()
+## Tool calls run in a bounded pool with a deadline per tool, so a hung
+## Yahoo or SEC request fails the call instead of stalling the chat
+tool_runtime = ToolRuntime(
+    max_workers = 16,
+    default_timeout = 60,
+    timeouts = {
+        "forecast": 300,
+        "search_10q_10k": 180,
+        "analyse": 120,
+        "evaluate_fundamentals": 120,
+    },
+)
+
+## Tools are imported and built in a background thread pool so that importing
+## this module stays fast; get_groupchat waits only for tools still initializing
+tool_registry = ToolRegistry(runtime=tool_runtime)
+tool_registry.register("calculator", "calculator_tools", "get_calculator_tool")
+tool_registry.register("data_analysis", "data_analysis_tools", "get_da_tools")
+tool_registry.register("fundamental", "fundamental_analysis_tools", "get_fa_tools")
+tool_registry.register("textbook", "rag_tools", "get_rag_tools")
+tool_registry.register("search", "search_tools", "get_tavily_tool")
+tool_registry.register("sec", "sec_tools", "get_sec_tool")
+tool_registry.register("technical", "technical_analysis_tools", "get_ta_tools")
+tool_registry.register("symbols", "symbol_tools", "get_symbol_tools")
+tool_registry.register("gmail", "gmail_tool", "get_gmail_tool")
+## read_artifact goes to every agent, since each of them sees the compacted
+## history, whose long messages point to the artifact store
+tool_registry.register("artifacts", "tool_outputs", "get_artifact_tools")
+tool_registry.warm_up()
+logger = logging.getLogger(__name__)
 
 Settings.llm = BedrockConverse(
     model = "anthropic.claude-3-5-sonnet-20240620-v1:0",
@@ -68,107 +94,165 @@ Settings.embed_model = BedrockEmbedding(
     aws_region_name = os.environ["AWS_DEFAULT_REGION"]
 )
 
+## Agent templates hold the tools, llm and llama-index workers. They are built
+## once per process and cloned for every chat session.
+agent_templates = {}
+_agent_templates_lock = threading.Lock()
+
+def get_agent_templates():
+    """Builds the agent templates on first use and returns them"""
+    with _agent_templates_lock:
+        if agent_templates:
+            return agent_templates
+        data_analyst = AgentTemplate(
+            llm = Settings.llm,
+            agent_name = "Principal_data_analyst",
+            tools = [
+                *tool_registry.get("data_analysis"),
+                *tool_registry.get("symbols"),
+                *tool_registry.get("artifacts"),
+            ],
+            system_message = """You are an expert in statistics and helps customers
+            develop data-driven insights from data analysis using statistical tools and
+            methods to guide decision-making.""",
+            agent_description = """This agent helps customers undertake statistical analysis
+            of financial market data using methods such as correlations, compounded annual
+            growth rate, etc.""",
+            agent_type = "react",
+        )
+
+        technical_analyst = AgentTemplate(
+            llm = Settings.llm,
+            agent_name = "Principal_technical_analyst",
+            tools = [
+                *tool_registry.get("technical"),
+                *tool_registry.get("symbols"),
+                *tool_registry.get("artifacts"),
+            ],
+            system_message = """You are the top technical analyst of the field, adroit
+            at crystallizing insights and ivnestment strategies from stock data. Use tools
+            to compute important technical analysis metrics to guide your investment 
+            recommendations.""",
+            agent_description="""This agent helps customers undertake technical analysis of
+            financial market data using methods such as stochastic relative strength index,
+            bollinger bands, ichimoku cloud, etc.""",
+            agent_type = "function",
+        )
+
+        fundamental_analyst = AgentTemplate(
+            agent_name="Principal_fundamental_analyst",
+            tools = [
+                *tool_registry.get("fundamental"),
+                *tool_registry.get("symbols"),
+                *tool_registry.get("artifacts"),
+            ],
+            system_message = """You are the top fundamental analst of the field, adroit
+            at crystallizing insights and investment strategies from stock data.""",
+            agent_description="""This agent helps customers undertake fundamental analysis
+            of companies by looking at financial market data.""",
+            llm = Settings.llm,
+            agent_type = "function",
+        )
+
+        research_analyst = AgentTemplate(
+            agent_name="Principal_researcher",
+            tools = [
+                *tool_registry.get("search"),
+                *tool_registry.get("sec"),
+                *tool_registry.get("calculator"),
+                *tool_registry.get("symbols"),
+                *tool_registry.get("artifacts"),
+            ],
+            system_message = """You are the top finance researcher of the field, adroit
+            at crystallizing insights and investment strategies from
+            close reading of SEC reports and research articles online.""",
+            agent_description="""This agent helps customers undertake analysis of the 
+            financial performance of companies by close reading of SEC reports and 
+            research articles online.""",
+            llm = Settings.llm,
+            agent_type = "react",
+        )
+
+        professor = AgentTemplate(
+            agent_name="Distinguished_professor_of_finance",
+            tools = [
+                *tool_registry.get("textbook"),
+                *tool_registry.get("artifacts"),
+            ],
+            system_message="""You are a distinguished professor of Finance with a 
+            specialization in investment finance. Your role is to answer specific
+            questions on finance and review the recommendations made by other agents.
+            Always provide a layman understanding of the metrics reported - for example
+            if the technical analysts says that the Aroon indicator shows a buy signal,
+            first explain what the indicator does and the interpretation of a buy signal.
+            Taking the signals from all metrics in totality, make a recommendation -
+            should the investor buy/sell/do more research?""",
+            agent_description="""Answers questions on technical definitions, concepts and 
+            general questions on how to get started on investments. This agent also reviews
+            the recommendations made by analysts
+            """,
+            llm = Settings.llm,
+            agent_type = "react",
+        )
+
+        reporter = AgentTemplate(
+            agent_name="Principal_finance_reporter",
+            tools = [
+                *tool_registry.get("gmail"),
+                *tool_registry.get("artifacts"),
+            ],
+            system_message="""You are a Pulitzer prize winning reporter adroit at 
+            distilling complex concepts to crystal clear insights easily understood by 
+            the layperson. You endeavor to help customers understand the investment 
+            recommendations put forth by your team. Only access the user's emails if
+            the user gives express permission.""",
+            agent_description = """Use this agent to write a report, draft emails and
+            send emails.""",
+            llm = Settings.llm
+        )
+
+        logger.info("Tool initialization timings:\n%s", tool_registry.report())
+        agent_templates.update({
+            "data_analyst": data_analyst,
+            "technical_analyst": technical_analyst,
+            "fundamental_analyst": fundamental_analyst,
+            "research_analyst": research_analyst,
+            "professor": professor,
+            "reporter": reporter,
+        })
+    return agent_templates
+
 def get_groupchat(llm_config = llm_config):
     """Instantiates group chat object. Returns user_proxy agent and
-    manager agent"""
+    manager agent. Agents are cloned from the shared templates, so only
+    their memory and message history are created per session."""
     user_proxy = ChainlitUserProxyAgent(
         name="Admin",
         human_input_mode="ALWAYS",
-        code_execution_config=False
+        code_execution_config=False,
     )
     
-    data_analyst = get_agent(
-        llm = Settings.llm,
-        agent_name = "Principal_data_analyst",
-        tools = [*da_tool],
-        system_message = """You are an expert in statistics and helps customers
-        develop data-driven insights from data analysis using statistical tools and
-        methods to guide decision-making.""",
-        agent_description = """This agent helps customers undertake statistical analysis
-        of financial market data using methods such as correlations, compounded annual
-        growth rate, etc.""",
-        agent_type = "react",
-    )
-
-    technical_analyst = get_agent(
-        llm = Settings.llm,
-        agent_name = "Principal_technical_analyst",
-        tools = [*ta_tool],
-        system_message = """You are the top technical analyst of the field, adroit
-        at crystallizing insights and ivnestment strategies from stock data. Use tools
-        to compute important technical analysis metrics to guide your investment 
-        recommendations.""",
-        agent_description="""This agent helps customers undertake technical analysis of
-        financial market data using methods such as stochastic relative strength index,
-        bollinger bands, ichimoku cloud, etc.""",
-        agent_type = "function",
-    )
-
-    fundamental_analyst = get_agent(
-        agent_name="Principal_fundamental_analyst",
-        tools = [fa_tool],
-        system_message = """You are the top fundamental analst of the field, adroit
-        at crystallizing insights and investment strategies from stock data.""",
-        agent_description="""This agent helps customers undertake fundamental analysis
-        of companies by looking at financial market data.""",
-        llm = Settings.llm,
-        agent_type = "function",
-    )
-
-    research_analyst = get_agent(
-        agent_name="Principal_researcher",
-        tools = [
-            *search_tool,
-            *sec_tool,
-            *calculator_tool,
-        ],
-        system_message = """You are the top finance researcher of the field, adroit
-        at crystallizing insights and investment strategies from
-        close reading of SEC reports and research articles online.""",
-        agent_description="""This agent helps customers undertake analysis of the 
-        financial performance of companies by close reading of SEC reports and 
-        research articles online.""",
-        llm = Settings.llm,
-        agent_type = "react",
-    )
-
-    professor = get_agent(
-        agent_name="Distinguished_professor_of_finance",
-        tools = [
-            *textbook_tool,
-        ],
-        system_message="""You are a distinguished professor of Finance with a 
-        specialization in investment finance. Your role is to answer specific
-        questions on finance and review the recommendations made by other agents.
-        Always provide a layman understanding of the metrics reported - for example
-        if the technical analysts says that the Aroon indicator shows a buy signal,
-        first explain what the indicator does and the interpretation of a buy signal.
-        Taking the signals from all metrics in totality, make a recommendation -
-        should the investor buy/sell/do more research?""",
-        agent_description="""Answers questions on technical definitions, concepts and 
-        general questions on how to get started on investments. This agent also reviews
-        the recommendations made by analysts
-        """,
-        llm = Settings.llm,
-        agent_type = "react",
-    )
+    templates = get_agent_templates()
+    data_analyst = templates["data_analyst"].clone()
+    technical_analyst = templates["technical_analyst"].clone()
+    fundamental_analyst = templates["fundamental_analyst"].clone()
+    research_analyst = templates["research_analyst"].clone()
+    professor = templates["professor"].clone()
+    reporter = templates["reporter"].clone()
 
-    reporter = get_agent(
-        agent_name="Principal_finance_reporter",
-        tools = [
-            *gmail_tool,
-        ],
-        system_message="""You are a Pulitzer prize winning reporter adroit at 
-        distilling complex concepts to crystal clear insights easily understood by 
-        the layperson. You endeavor to help customers understand the investment 
-        recommendations put forth by your team. Only access the user's emails if
-        the user gives express permission.""",
-        agent_description = """Use this agent to write a report, draft emails and
-        send emails.""",
-        llm = Settings.llm
+    ## Investment recommendations need both analysts, which don't depend on
+    ## each other, so the panel runs them at the same time
+    analysis_panel = ChainlitFanOutAgent(
+        name = "Investment_analysis_panel",
+        members = [technical_analyst, fundamental_analyst],
+        optional_members = {data_analyst: r"forecast|predict|correlat|\bcagr\b"},
+        description = """Runs the principal technical analyst and the principal
+        fundamental analyst at the same time for investment recommendations on a
+        stock, e.g. 'should I buy NVDA?'""",
     )
 
     agents = [
+        analysis_panel,
         technical_analyst,
         data_analyst,
         fundamental_analyst,
@@ -178,12 +262,81 @@ def get_groupchat(llm_config = llm_config):
         research_analyst
     ]
 
-    groupchat = autogen.GroupChat(
+    ## Cheap routing for the user's messages. Anything the keyword vote and
+    ## the embedding classifier can't settle is still routed by the LLM.
+    speaker_selector = SpeakerSelector(
+        router = user_proxy,
+        routes = {
+            analysis_panel: SpeakerRoute(
+                keywords = [
+                    r"should (i|we) (buy|sell|hold|invest)", r"\b(buy|sell|hold)\b.*\?",
+                    r"recommend", r"worth (buying|investing)", r"\binvest in\b",
+                ],
+                description = analysis_panel.description,
+            ),
+            technical_analyst: SpeakerRoute(
+                keywords = [
+                    r"\btechnical\b", r"\brsi\b", r"\bmacd\b", r"bollinger", r"ichimoku",
+                    r"\baroon\b", r"stochastic", r"moving average", r"momentum",
+                    r"support|resistance", r"chart", r"\bsignal",
+                ],
+                description = technical_analyst.description,
+            ),
+            fundamental_analyst: SpeakerRoute(
+                keywords = [
+                    r"fundamental", r"\bp/?e\b", r"valuation", r"earnings", r"balance sheet",
+                    r"cash ?flow", r"dividend", r"\bratios?\b", r"undervalued|overvalued",
+                ],
+                description = fundamental_analyst.description,
+            ),
+            data_analyst: SpeakerRoute(
+                keywords = [
+                    r"forecast", r"predict", r"correlat", r"\bcagr\b", r"compounded",
+                    r"statistic", r"regression", r"volatility",
+                ],
+                description = data_analyst.description,
+            ),
+            research_analyst: SpeakerRoute(
+                keywords = [
+                    r"\bsec\b", r"10-?k", r"10-?q", r"filing", r"\bnews\b", r"article",
+                    r"annual report",
+                ],
+                description = research_analyst.description,
+            ),
+            professor: SpeakerRoute(
+                keywords = [
+                    rf"^(?:{re.escape(TASK_PREFIX)})?\s*what (is|are|does)\b", r"\bexplain", r"\bdefin", r"meaning of",
+                    r"concept", r"get started|how do i start|beginner",
+                ],
+                description = professor.description,
+            ),
+            reporter: SpeakerRoute(
+                keywords = [
+                    r"\bwrite\b.*\breport\b", r"\bsummar", r"e-?mail", r"\bdraft\b",
+                ],
+                description = reporter.description,
+            ),
+        },
+        embed_fn = Settings.embed_model.get_text_embedding,
+    )
+
+    ## Every agent sees recent turns verbatim and a running summary of the rest
+    history = HistoryCompactor(
+        summarize_fn = lambda prompt: Settings.llm.complete(prompt).text,
+    )
+    compaction = TransformMessages(transforms=[history], verbose=False)
+    for agent in agents:
+        if agent is not user_proxy:
+            compaction.add_to_agent(agent)
+
+    groupchat = CompactingGroupChat(
+        history = history,
         agents = agents,
         messages = [],
         max_round = 5000,
         allowed_or_disallowed_speaker_transitions = {
             user_proxy: [
+                analysis_panel,
                 technical_analyst, 
                 fundamental_analyst,
                 data_analyst,
@@ -191,6 +344,7 @@ def get_groupchat(llm_config = llm_config):
                 professor,
                 reporter,
             ],
+            analysis_panel: [professor],
             technical_analyst:[professor],
             fundamental_analyst: [professor],
             data_analyst: [user_proxy],
@@ -200,12 +354,15 @@ def get_groupchat(llm_config = llm_config):
         },
         enable_clear_history = False,
         speaker_transitions_type="allowed",
+        speaker_selection_method=speaker_selector,
         select_speaker_message_template="""
         You spearhead an investment crew known as The Margin Call. 
         
-        Route all investment analysis related questions to either the principal 
-        technical analyst or the principal fundamental analyst. Once either 
-        analyst is done with their tasks, they'll route it to the distinguished 
+        Route requests for an investment recommendation on a stock, which need
+        both technical and fundamental analysis, to the investment analysis panel.
+        Route all other investment analysis related questions to either the principal 
+        technical analyst or the principal fundamental analyst. Once the panel or
+        either analyst is done with their tasks, they'll route it to the distinguished 
         professor of finance for review.
         
         Use the data analyst for all forecasting tasks.
@@ -0,0 +1,231 @@
+#%%
+import os
+import sys
+import time
+import hashlib
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from artifact_store import artifact_store
+from tracing import approx_tokens, message_text, set_span_attributes, span
+
+from autogen import Agent, GroupChat
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_NAME = "conversation_summary"
+
+## Summaries of all sessions are made here, off the event loop
+_summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history-summary")
+
+SUMMARY_PROMPT = """You maintain the running summary of a conversation between
+an investor and a team of finance agents. Update the summary with the new
+messages below. Keep every ticker, date range, figure, recommendation and
+open request, and drop pleasantries. Answer with the updated summary only.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+"""
+
+def _messages_tokens(messages: List[Dict]) -> int:
+    return sum(approx_tokens(message_text(message)) for message in messages)
+
+#%%
+class HistoryCompactor:
+    """Bounds the prompt of long group chats. Implements autogen's
+    ``MessageTransform`` protocol so it can be added to agents with
+    ``TransformMessages``.
+
+    The most recent messages are kept verbatim. Older messages are folded, a
+    batch at a time, into a running summary produced by ``summarize_fn``.
+    Summaries are made on a background thread, since the transform runs inside
+    autogen's synchronous hooks on the event loop; until a newer summary is
+    ready, the latest cached one is used and the messages it doesn't cover are
+    sent as they are. Summaries are cached on the content of the messages they
+    cover, so every agent in the chat (and the speaker selection) reuses the
+    same summary and each message is only summarized once. Long messages other than the last
+    one are moved into the artifact store and replaced by a short reference.
+
+    Args:
+        summarize_fn: maps a prompt to the summary text, e.g. ``lambda p: llm.complete(p).text``
+        keep_recent: number of recent messages kept verbatim
+        summarize_every: how many messages are folded into the summary at a time
+        max_message_chars: messages longer than this are replaced by an artifact reference
+        preview_chars: how much of a replaced message is kept as a preview
+    """
+
+    def __init__(
+        self,
+        summarize_fn: Callable[[str], str],
+        keep_recent: int = 8,
+        summarize_every: int = 6,
+        max_message_chars: int = 3000,
+        preview_chars: int = 500,
+    ):
+        self.summarize_fn = summarize_fn
+        self.keep_recent = keep_recent
+        self.summarize_every = summarize_every
+        self.max_message_chars = max_message_chars
+        self.preview_chars = preview_chars
+        self._summaries: Dict[str, Tuple[int, str]] = {}
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self.turns = deque(maxlen=1000)
+
+    @staticmethod
+    def _prefix_hashes(messages: List[Dict]) -> List[str]:
+        """Chained hash of every message prefix, independent of message roles so
+        that the copies held by different agents map to the same keys"""
+        hashes, digest = [], ""
+        for message in messages:
+            digest = hashlib.sha1(
+                f"{digest}|{message.get('name', '')}|{message_text(message)}".encode()
+            ).hexdigest()
+            hashes.append(digest)
+        return hashes
+
+    def _format(self, messages: List[Dict]) -> str:
+        return "\n\n".join(
+            f"{message.get('name') or message.get('role', 'user')}: {message_text(message)}"
+            for message in messages
+        )
+
+    def _summary_for(self, old: List[Dict]) -> Tuple[int, str]:
+        """Returns how many of the ``old`` messages are covered by the latest
+        summary, and the summary. If enough messages are not covered yet, a
+        newer summary is started in the background."""
+        hashes = self._prefix_hashes(old)
+        with self._lock:
+            covered, summary = 0, ""
+            for i in range(len(hashes) - 1, -1, -1):
+                if hashes[i] in self._summaries:
+                    covered, summary = self._summaries[hashes[i]]
+                    break
+            start_key = hashes[covered - 1] if covered else ""
+            pending = len(old) - covered >= self.summarize_every
+            if pending and start_key not in self._pending:
+                self._pending.add(start_key)
+                _summary_executor.submit(
+                    contextvars.copy_context().run,
+                    self._summarize, old[covered:], hashes[covered:], covered, summary, start_key,
+                )
+        set_span_attributes(summary_cache_hit=covered > 0, summary_pending=pending)
+        return covered, summary
+
+    def _summarize(self, messages: List[Dict], hashes: List[str], covered: int, summary: str, start_key: str):
+        """Folds messages into the summary a batch at a time, caching every step"""
+        try:
+            done = 0
+            while len(messages) - done >= self.summarize_every:
+                batch = messages[done:done + self.summarize_every]
+                prompt = SUMMARY_PROMPT.format(
+                    summary = summary or "(empty)",
+                    messages = self._format([self._compact_message(m) for m in batch]),
+                )
+                with span("history.summarize", messages=len(batch)) as summarization:
+                    summary = self.summarize_fn(prompt)
+                    summarization.set_attributes(
+                        input_tokens = len(prompt) // 4, output_tokens = len(summary) // 4
+                    )
+                done += len(batch)
+                with self._lock:
+                    self._summaries[hashes[done - 1]] = (covered + done, summary)
+        except Exception:
+            logger.exception("Could not summarize the conversation history")
+        finally:
+            with self._lock:
+                self._pending.discard(start_key)
+
+    def _compact_message(self, message: Dict) -> Dict:
+        text = message_text(message)
+        if len(text) <= self.max_message_chars:
+            return message
+        artifact_id = artifact_store.put(text)
+        return dict(message, content = text[:self.preview_chars] + "\n" + artifact_store.reference(
+            artifact_id, f"{len(text)} characters omitted from the conversation history, page through them with the read_artifact tool"
+        ))
+
+    def _compact_messages(self, messages: List[Dict]) -> List[Dict]:
+        """Compacts all but the last message, which the agent is replying to"""
+        return [self._compact_message(m) for m in messages[:-1]] + messages[-1:]
+
+    def apply_transform(self, messages: List[Dict]) -> List[Dict]:
+        # Messages passed on by another agent (e.g. a fan-out panel) are already compact
+        if not messages or any(m.get("name") == SUMMARY_NAME for m in messages):
+            return messages
+        with span("history.compact") as compaction:
+            compacted = self._apply_transform(messages)
+            compaction.set_attributes(**self.turns[-1])
+            return compacted
+
+    def _apply_transform(self, messages: List[Dict]) -> List[Dict]:
+        start = time.perf_counter()
+        old, recent = messages[:-self.keep_recent], messages[-self.keep_recent:]
+        compacted = self._compact_messages(recent)
+        if old:
+            covered, summary = self._summary_for(old)
+            compacted = [self._compact_message(m) for m in old[covered:]] + compacted
+            if summary:
+                compacted.insert(0, {
+                    "role": "user",
+                    "name": SUMMARY_NAME,
+                    "content": f"Summary of the earlier conversation:\n{summary}",
+                })
+        self.turns.append({
+            "messages_in": len(messages),
+            "messages_out": len(compacted),
+            "tokens_in": _messages_tokens(messages),
+            "tokens_out": _messages_tokens(compacted),
+            "seconds": round(time.perf_counter() - start, 4),
+        })
+        logger.info("History compaction: %s", self.turns[-1])
+        return compacted
+
+    def get_logs(self, pre_transform_messages: List[Dict], post_transform_messages: List[Dict]) -> Tuple[str, bool]:
+        if pre_transform_messages is post_transform_messages or not self.turns:
+            return "", False
+        turn = self.turns[-1]
+        return (
+            f"Compacted {turn['messages_in']} messages ({turn['tokens_in']} tokens) "
+            f"to {turn['messages_out']} messages ({turn['tokens_out']} tokens)."
+        ), turn["tokens_out"] < turn["tokens_in"]
+
+@dataclass
+class CompactingGroupChat(GroupChat):
+    """GroupChat whose LLM speaker selection sees the compacted history instead
+    of the full transcript"""
+
+    history: Optional[HistoryCompactor] = None
+
+    def _compact(self, messages: Optional[List[Dict]]) -> Optional[List[Dict]]:
+        return self.history.apply_transform(messages) if self.history and messages else messages
+
+    def _auto_select_speaker(self, last_speaker, selector, messages, agents) -> Agent:
+        with span("speaker_selection.llm", last_speaker=last_speaker.name) as selection:
+            messages = self._compact(messages)
+            speaker = super()._auto_select_speaker(last_speaker, selector, messages, agents)
+            selection.set_attribute("selected", speaker.name)
+            return speaker
+
+    async def a_select_speaker(self, last_speaker, selector) -> Agent:
+        # Selection methods are called synchronously; let them do their slow work off the loop first
+        prepare = getattr(self.speaker_selection_method, "prepare", None)
+        if prepare is not None:
+            await prepare(last_speaker, self)
+        return await super().a_select_speaker(last_speaker, selector)
+
+    async def a_auto_select_speaker(self, last_speaker, selector, messages, agents) -> Agent:
+        with span("speaker_selection.llm", last_speaker=last_speaker.name) as selection:
+            messages = self._compact(messages)
+            speaker = await super().a_auto_select_speaker(last_speaker, selector, messages, agents)
+            selection.set_attribute("selected", speaker.name)
+            return speaker
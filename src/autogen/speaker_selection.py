@@ -0,0 +1,198 @@
+#%%
+import os
+import re
+import sys
+import asyncio
+import logging
+import threading
+import numpy as np
+from collections import Counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from autogen import Agent, GroupChat
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracing import message_text, set_span_attributes, span
+
+logger = logging.getLogger(__name__)
+
+class SpeakerRoute(NamedTuple):
+    """Routing hints for one agent.
+
+    Args:
+        keywords: regex patterns that vote for this agent when found in the user's message
+        description: what the agent handles, embedded for the similarity fallback
+    """
+    keywords: List[str]
+    description: str
+
+## Route descriptions are embedded once per process and shared across sessions
+_description_embeddings: Dict[str, np.ndarray] = {}
+_description_embeddings_lock = threading.Lock()
+
+def _embed_descriptions(
+    descriptions: List[str],
+    embed_fn: Callable[[str], List[float]]
+) -> np.ndarray:
+    with _description_embeddings_lock:
+        for description in descriptions:
+            if description not in _description_embeddings:
+                vector = np.asarray(embed_fn(description), dtype=np.float32)
+                _description_embeddings[description] = vector / (np.linalg.norm(vector) + 1e-12)
+        return np.stack([_description_embeddings[d] for d in descriptions])
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+#%%
+class SpeakerSelector:
+    """Callable ``speaker_selection_method`` for ``autogen.GroupChat`` that only
+    asks the manager's LLM to pick the next speaker when the choice is ambiguous.
+
+    The next speaker is chosen, in order, by:
+        1. ``deterministic``: the allowed transitions leave a single candidate
+        2. ``keyword``: after the router speaks, exactly one route wins the keyword vote
+        3. ``embedding``: the router's message is clearly closest to one route description
+        4. ``llm``: otherwise "auto" is returned and autogen queries the LLM as before
+
+    autogen calls the selector synchronously, also from ``a_select_speaker``, so
+    embeddings are never requested from a running event loop. Async group chats
+    await ``prepare`` first, which embeds the router's message in a worker
+    thread; without it the embedding step is skipped on the loop.
+
+    Args:
+        router: the agent whose messages are classified (the user proxy)
+        routes: routing hints for every agent the router can hand over to
+        embed_fn: text embedding function. The embedding step is skipped if None
+        similarity_threshold: minimum cosine similarity for an embedding route
+        min_margin: minimum lead of the best route over the runner-up
+    """
+
+    def __init__(
+        self,
+        router: Agent,
+        routes: Dict[Agent, SpeakerRoute],
+        embed_fn: Optional[Callable[[str], List[float]]] = None,
+        similarity_threshold: float = 0.5,
+        min_margin: float = 0.05,
+    ):
+        self.router = router
+        self.routes = routes
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self.min_margin = min_margin
+        self._patterns = {
+            agent: [re.compile(pattern, re.IGNORECASE) for pattern in route.keywords]
+            for agent, route in routes.items()
+        }
+        self.counts = Counter()
+        self._query_embedding: Optional[Tuple[str, np.ndarray]] = None
+
+    def __call__(self, last_speaker: Agent, groupchat: GroupChat) -> Union[Agent, str]:
+        with span("speaker_selection", last_speaker=last_speaker.name):
+            return self._select(last_speaker, groupchat)
+
+    async def prepare(self, last_speaker: Agent, groupchat: GroupChat):
+        """Embeds the route descriptions and the router's message in a worker
+        thread, for a following selection to use without blocking the loop"""
+        routing = self._routing_text(last_speaker, groupchat)
+        if routing is None or self.embed_fn is None:
+            return
+        text, eligible = routing
+        if len(eligible) < 2 or self._keyword_route(text, eligible) is not None:
+            return
+        if self._query_embedding is not None and self._query_embedding[0] == text:
+            return
+        try:
+            await asyncio.to_thread(
+                _embed_descriptions, [self.routes[agent].description for agent in eligible], self.embed_fn
+            )
+            query = await asyncio.to_thread(self.embed_fn, text)
+        except Exception:
+            logger.exception("Embedding the router's message failed, falling back to the LLM")
+            return
+        self._query_embedding = (text, np.asarray(query, dtype=np.float32))
+
+    def _routing_text(self, last_speaker: Agent, groupchat: GroupChat) -> Optional[Tuple[str, List[Agent]]]:
+        """The router's last message and the routed agents it can hand over to"""
+        if last_speaker is not self.router or not groupchat.messages:
+            return None
+        candidates = groupchat.allowed_speaker_transitions_dict.get(last_speaker, [])
+        eligible = [agent for agent in candidates if agent in groupchat.agents and agent in self.routes]
+        text = message_text(groupchat.messages[-1])
+        return (text, eligible) if text.strip() and eligible else None
+
+    def _select(self, last_speaker: Agent, groupchat: GroupChat) -> Union[Agent, str]:
+        candidates = groupchat.allowed_speaker_transitions_dict.get(last_speaker, [])
+        candidates = [agent for agent in candidates if agent in groupchat.agents]
+        if len(candidates) == 1:
+            return self._record("deterministic", last_speaker, candidates[0])
+
+        routing = self._routing_text(last_speaker, groupchat)
+        if routing is not None:
+            text, eligible = routing
+            selected = self._keyword_route(text, eligible)
+            if selected is not None:
+                return self._record("keyword", last_speaker, selected)
+            selected = self._embedding_route(text, eligible)
+            if selected is not None:
+                return self._record("embedding", last_speaker, selected)
+
+        self._record("llm", last_speaker, None)
+        return "auto"
+
+    def _keyword_route(self, text: str, candidates: List[Agent]) -> Optional[Agent]:
+        votes = {
+            agent: sum(1 for pattern in self._patterns[agent] if pattern.search(text))
+            for agent in candidates
+        }
+        best = max(votes.values())
+        winners = [agent for agent, count in votes.items() if count == best]
+        return winners[0] if best > 0 and len(winners) == 1 else None
+
+    def _embedding_route(self, text: str, candidates: List[Agent]) -> Optional[Agent]:
+        if self.embed_fn is None or len(candidates) < 2:
+            return None
+        descriptions = [self.routes[agent].description for agent in candidates]
+        if self._query_embedding is not None and self._query_embedding[0] == text:
+            query = self._query_embedding[1]
+            with _description_embeddings_lock:
+                if not all(d in _description_embeddings for d in descriptions):
+                    return None
+                matrix = np.stack([_description_embeddings[d] for d in descriptions])
+        elif _in_event_loop():
+            # Not prepared: an embedding request here would stall every session
+            return None
+        else:
+            try:
+                matrix = _embed_descriptions(descriptions, self.embed_fn)
+                query = np.asarray(self.embed_fn(text), dtype=np.float32)
+            except Exception:
+                logger.exception("Embedding speaker selection failed, falling back to the LLM")
+                return None
+        scores = matrix @ (query / (np.linalg.norm(query) + 1e-12))
+        ranked = np.argsort(-scores)
+        best, runner_up = scores[ranked[0]], scores[ranked[1]]
+        if best >= self.similarity_threshold and best - runner_up >= self.min_margin:
+            return candidates[int(ranked[0])]
+        return None
+
+    def _record(self, path: str, last_speaker: Agent, selected: Optional[Agent]):
+        self.counts[path] += 1
+        set_span_attributes(path=path, selected=selected.name if selected else "")
+        logger.info(
+            "Speaker selection via %s: %s -> %s",
+            path, last_speaker.name, selected.name if selected else "LLM",
+        )
+        return selected
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """How often each selection path was taken, and the share that skipped the LLM"""
+        total = sum(self.counts.values())
+        stats = {path: self.counts[path] for path in ("deterministic", "keyword", "embedding", "llm")}
+        stats["llm_skip_rate"] = round(1 - self.counts["llm"] / total, 4) if total else 0.0
+        return stats
@@ -0,0 +1,80 @@
+#%%
+import time
+import logging
+import importlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from llama_index.core.tools import BaseTool, FunctionTool
+
+logger = logging.getLogger(__name__)
+
+class ToolRegistry:
+    """Builds agent tool lists off the import path.
+
+    Each tool is registered as a ``(module, factory)`` pair and is only imported and
+    constructed when it is first requested, or concurrently in a thread pool when
+    ``warm_up`` is called. A factory that fails (e.g. a backend is down) is logged
+    and yields an empty tool list instead of failing the whole group chat.
+    If a ``runtime`` is given, every function tool is wrapped to run under it.
+    """
+
+    def __init__(self, max_workers: int = 8, runtime = None):
+        self._factories: Dict[str, Tuple[str, str]] = {}
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers = max_workers,
+            thread_name_prefix = "tool-init"
+        )
+        self.runtime = runtime
+        self.timings: Dict[str, float] = {}
+        self.errors: Dict[str, BaseException] = {}
+
+    def register(self, name: str, module: str, factory: str):
+        """Registers ``module.factory()`` as the builder for tool ``name``"""
+        self._factories[name] = (module, factory)
+
+    def _build(self, name: str) -> List[BaseTool]:
+        module, factory = self._factories[name]
+        start = time.perf_counter()
+        try:
+            tools = getattr(importlib.import_module(module), factory)()
+        except Exception as e:
+            self.errors[name] = e
+            logger.exception("Failed to initialize tool '%s'", name)
+            tools = []
+        finally:
+            self.timings[name] = time.perf_counter() - start
+        logger.info("Initialized tool '%s' in %.2fs", name, self.timings[name])
+        tools = tools if isinstance(tools, list) else [tools]
+        if self.runtime is not None:
+            tools = [
+                self.runtime.wrap(tool) if isinstance(tool, FunctionTool) else tool
+                for tool in tools
+            ]
+        return tools
+
+    def _submit(self, name: str) -> Future:
+        with self._lock:
+            if name not in self._futures:
+                self._futures[name] = self._executor.submit(self._build, name)
+            return self._futures[name]
+
+    def warm_up(self, names: Optional[List[str]] = None):
+        """Starts building tools in the background without waiting for them"""
+        for name in names or self._factories:
+            self._submit(name)
+
+    def get(self, name: str, timeout: Optional[float] = None) -> List[BaseTool]:
+        """Returns the tool list for ``name``, building it if needed"""
+        return self._submit(name).result(timeout=timeout)
+
+    def report(self) -> str:
+        """Per-tool initialization timings, slowest first"""
+        lines = []
+        for name, seconds in sorted(self.timings.items(), key=lambda item: -item[1]):
+            status = f"failed: {self.errors[name]}" if name in self.errors else "ok"
+            lines.append(f"{name:<20}{seconds:>8.2f}s  {status}")
+        return "\n".join(lines)
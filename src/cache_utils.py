@@ -0,0 +1,176 @@
+#%%
+import re
+import json
+import time
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+## Registry of named caches so hit rates can be exported from one place
+_caches: Dict[str, "TTLCache"] = {}
+
+def register_cache(name: str, cache: "TTLCache") -> "TTLCache":
+    """Registers a cache under a name for stats export"""
+    _caches[name] = cache
+    return cache
+
+def get_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Returns hit/miss counters for every registered cache"""
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+def export_cache_stats(path: str):
+    """Writes the stats of every registered cache to a JSON file"""
+    with open(path, "w") as file:
+        json.dump(get_cache_stats(), file, indent=2)
+
+def normalize_query(query: str) -> str:
+    """Lowercases a query and strips punctuation and repeated whitespace so that
+    trivially different phrasings share a cache key"""
+    query = re.sub(r"[^\w\s/%.-]", " ", query.lower())
+    query = re.sub(r"[.\s]+$", "", query.strip())
+    return re.sub(r"\s+", " ", query)
+
+#%%
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds"""
+
+    def __init__(self, max_size: int = 256, ttl: Optional[float] = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._expired(entry[0]):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and not self._expired(entry[0])
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """Returns the live (unexpired) entries, oldest first"""
+        with self._lock:
+            return [(key, value) for key, (stored_at, value) in self._data.items()
+                    if not self._expired(stored_at)]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class SemanticCache(TTLCache):
+    """TTL/LRU cache keyed by normalized query text, with a fallback lookup on
+    embedding similarity for near-duplicate queries.
+
+    Args:
+        embed_fn: maps a query, as asked, to its embedding
+        similarity_threshold: minimum cosine similarity for a near-duplicate hit
+        signature_fn: maps a query to the terms a near-duplicate must share,
+            e.g. so 'What is the P/E ratio' doesn't get the answer about P/B
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[str], List[float]],
+        similarity_threshold: float = 0.95,
+        max_size: int = 256,
+        ttl: Optional[float] = 24 * 3600,
+        signature_fn: Optional[Callable[[str], Hashable]] = None,
+    ):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self.signature_fn = signature_fn
+        self.exact_hits = 0
+        self.semantic_hits = 0
+
+    def lookup(self, query: str) -> Tuple[Optional[Any], Optional[List[float]]]:
+        """Returns the cached value for a query (or None) and the query embedding
+        if one had to be computed, so callers can reuse it on a miss. The
+        embedding is of the query as asked, not of its normalized key."""
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._data.move_to_end(key)
+                self.hits += 1
+                self.exact_hits += 1
+                return entry[1][0], None
+
+        embedding = self.embed_fn(query)
+        signature = self._signature(query)
+        entries = [(key, value) for key, value in self.items() if value[2] == signature]
+        if entries:
+            matrix = np.asarray([value[1] for _, value in entries], dtype=np.float32)
+            query_vector = np.asarray(embedding, dtype=np.float32)
+            scores = matrix @ query_vector / (
+                np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector) + 1e-12
+            )
+            best = int(np.argmax(scores))
+            if scores[best] >= self.similarity_threshold:
+                with self._lock:
+                    self.hits += 1
+                    self.semantic_hits += 1
+                logger.debug("Semantic cache hit for %r (similarity %.3f)", query, scores[best])
+                return entries[best][1][0], embedding
+        with self._lock:
+            self.misses += 1
+        return None, embedding
+
+    def _signature(self, query: str) -> Hashable:
+        return self.signature_fn(query) if self.signature_fn is not None else None
+
+    def store(self, query: str, value: Any, embedding: Optional[List[float]] = None):
+        if embedding is None:
+            embedding = self.embed_fn(query)
+        self.set(normalize_query(query), (value, embedding, self._signature(query)))
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats.update({
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+        })
+        return stats
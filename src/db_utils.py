@@ -1,31 +1,104 @@
 #%%
+import sys
+import logging
+import argparse
 import requests
 import yfinance as yf
 import pandas as pd
-from sqlalchemy import (
-    create_engine,
-    MetaData,
-    Table,
-    Column,
-    Float,
-    DateTime,
-    Integer
-)
+from sqlalchemy import create_engine
 import sqlite3
-from typing import Optional, Literal
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Literal, Union
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from symbol_index import SymbolRecord, symbol_index
+from analytics_tables import refresh_analytics
 
-def get_ticker(company_name: str):
-    yfinance = "https://query2.finance.yahoo.com/v1/finance/search"
-    user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
-    params = {"q": company_name, "quotes_count": 1, "country": "United States"}
+logger = logging.getLogger(__name__)
+
+## Daily prices of every ticker in one table, clustered by (ticker, date) so a
+## ticker's date range is a single index seek. The (date, ticker) index serves
+## cross-sectional queries such as all closes on one day.
+PRICES_TABLE = "prices"
+PRICES_COLUMNS = ["ticker", "date", "open", "high", "low", "close", "adj_close", "volume"]
+PRICES_DDL = """
+CREATE TABLE IF NOT EXISTS prices (
+    ticker TEXT NOT NULL,
+    date TEXT NOT NULL,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    adj_close REAL,
+    volume INTEGER,
+    PRIMARY KEY (ticker, date)
+) WITHOUT ROWID
+"""
+PRICES_DATE_INDEX = "CREATE INDEX IF NOT EXISTS prices_date_ticker ON prices (date, ticker)"
+
+## Rows that already hold the same values are left alone, so re-fetched
+## overlap days cost a lookup but no write
+UPSERT_PRICES = f"""
+INSERT INTO prices ({", ".join(PRICES_COLUMNS)})
+VALUES ({", ".join("?" * len(PRICES_COLUMNS))})
+ON CONFLICT (ticker, date) DO UPDATE SET
+    {", ".join(f"{c} = excluded.{c}" for c in PRICES_COLUMNS[2:])}
+WHERE {" OR ".join(f"prices.{c} IS NOT excluded.{c}" for c in PRICES_COLUMNS[2:])}
+"""
+
+## WAL lets the app read while prices are written; NORMAL sync is durable in
+## WAL mode except for the last commits on power loss, which a reload recovers
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64_000, # KiB
+    "mmap_size": 256 * 2**20,
+    "busy_timeout": 10_000, # ms
+}
+
+def connect_db(db_path: str) -> sqlite3.Connection:
+    """Opens the database for writing with the pragmas above"""
+    conn = sqlite3.connect(db_path)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+YAHOO_SEARCH_URL = "https://query2.finance.yahoo.com/v1/finance/search"
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
 
-    res = requests.get(url=yfinance, params=params, headers={'User-Agent': user_agent})
-    data = res.json()
+def search_yahoo(company_name: str) -> Optional[SymbolRecord]:
+    """Looks a company up on Yahoo Finance. Equities are preferred over the
+    funds, futures and indices the search also returns."""
+    params = {"q": company_name, "quotes_count": 5, "country": "United States"}
+    res = requests.get(url=YAHOO_SEARCH_URL, params=params, headers={'User-Agent': USER_AGENT}, timeout=10)
+    quotes = [quote for quote in res.json().get("quotes", []) if quote.get("symbol")]
+    if not quotes:
+        return None
+    quote = next((quote for quote in quotes if quote.get("quoteType") == "EQUITY"), quotes[0])
+    return SymbolRecord(
+        ticker = quote["symbol"],
+        name = quote.get("longname") or quote.get("shortname") or company_name,
+        exchange = quote.get("exchDisp") or quote.get("exchange", ""),
+        aliases = (company_name,),
+    )
 
-    company_code = data['quotes'][0]['symbol']
-    return company_code
+def get_ticker(company_name: str):
+    """Resolves a company name to its ticker from the local symbol index.
+    Yahoo Finance is only searched for names the index doesn't know, and the
+    answer is added to the index."""
+    record = symbol_index.resolve(company_name)
+    if record is not None:
+        return record.ticker
+    record = search_yahoo(company_name)
+    if record is None:
+        raise ValueError(f"No ticker found for '{company_name}'")
+    symbol_index.add(record)
+    try:
+        symbol_index.save()
+    except OSError:
+        logger.warning("Could not save the symbol index to %s", symbol_index.path)
+    return record.ticker
 # %%
 
 def get_start_date(years: int = 10):
@@ -59,48 +132,196 @@ def connect_sql(db_path: str):
     engine = create_engine(f"sqlite:///{db_path}")
     return engine, tables
 
+def normalize_prices(ticker: str, data: pd.DataFrame) -> pd.DataFrame:
+    """Turns a yfinance download into rows of the prices table. Dates are stored
+    as ISO 'YYYY-MM-DD' text so they sort and compare correctly."""
+    data = data.copy()
+    if isinstance(data.columns, pd.MultiIndex): # newer yfinance adds a Ticker level
+        data.columns = data.columns.get_level_values(0)
+    data = data.reset_index()
+    data.columns = [str(column).lower().replace(" ", "_") for column in data.columns]
+    if "adj_close" not in data.columns:
+        data["adj_close"] = data["close"]
+    data["ticker"] = ticker.upper()
+    data["date"] = pd.to_datetime(data["date"]).dt.strftime("%Y-%m-%d")
+    return data[PRICES_COLUMNS]
+
+def price_rows(data: pd.DataFrame):
+    """Rows of a normalized prices frame as Python values sqlite3 can bind"""
+    data = data.astype(object).where(data.notna(), None)
+    return data.itertuples(index=False, name=None)
+
+def create_prices_table(conn: sqlite3.Connection):
+    conn.execute(PRICES_DDL)
+    conn.execute(PRICES_DATE_INDEX)
+
+def _is_ticker_table(conn: sqlite3.Connection, table: str) -> bool:
+    """Whether a table is one of the old per-ticker price tables"""
+    if table == PRICES_TABLE or table.startswith("sqlite_"):
+        return False
+    columns = {row[1].lower() for row in conn.execute(f'PRAGMA table_info("{table}")')}
+    return {"date", "open", "high", "low", "close", "volume"} <= columns
+
+def migrate_ticker_tables(db_path: str, drop_tables: bool = False) -> List[str]:
+    """Copies the rows of the old one-table-per-ticker layout into the prices
+    table, in one transaction. Tickers that already have prices are skipped,
+    so it is cheap to run on every start and never overwrites newer prices.
+
+    The old tables are kept unless ``drop_tables`` is set, and then only the
+    ones whose every dated row is found in the prices table are dropped.
+
+    Returns:
+        the tickers that were migrated
+    """
+    conn = connect_db(db_path)
+    dropped = []
+    try:
+        with conn:
+            create_prices_table(conn)
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )]
+            tables = [table for table in tables if _is_ticker_table(conn, table)]
+            migrated = [
+                table for table in tables
+                if conn.execute("SELECT 1 FROM prices WHERE ticker = ? LIMIT 1", (table.upper(),)).fetchone() is None
+            ]
+            for table in migrated:
+                columns = {row[1].lower() for row in conn.execute(f'PRAGMA table_info("{table}")')}
+                adj_close = '"Adj Close"' if "adj close" in columns else "close"
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO prices ({", ".join(PRICES_COLUMNS)})
+                    SELECT ?, substr(date, 1, 10), open, high, low, close, {adj_close}, volume
+                    FROM "{table}"
+                    WHERE date IS NOT NULL
+                """, (table.upper(),))
+            for table in tables if drop_tables else []:
+                missing = conn.execute(f"""
+                    SELECT COUNT(*) FROM "{table}" t
+                    WHERE t.date IS NOT NULL AND NOT EXISTS (
+                        SELECT 1 FROM prices p WHERE p.ticker = ? AND p.date = substr(t.date, 1, 10)
+                    )
+                """, (table.upper(),)).fetchone()[0]
+                if missing:
+                    logger.warning("Kept table %s: %d of its rows are not in the prices table", table, missing)
+                    continue
+                conn.execute(f'DROP TABLE "{table}"')
+                dropped.append(table)
+    finally:
+        conn.close()
+    if migrated:
+        logger.info("Migrated %d ticker tables into the prices table", len(migrated))
+    if dropped:
+        logger.info("Dropped %d migrated ticker tables", len(dropped))
+    return migrated
+
+def get_tickers(db_path: str) -> List[str]:
+    """Tickers that have prices in the database"""
+    conn = connect_db(db_path)
+    try:
+        create_prices_table(conn)
+        return [row[0] for row in conn.execute("SELECT DISTINCT ticker FROM prices ORDER BY ticker")]
+    finally:
+        conn.close()
+
+def upsert_prices(conn: sqlite3.Connection, data: pd.DataFrame, batch_size: int = 50_000) -> int:
+    """Inserts or updates normalized price rows of any number of tickers in one
+    transaction. Rows are written in primary key order, which keeps inserts
+    into the clustered table sequential.
+
+    Returns:
+        the number of rows written
+    """
+    data = data.sort_values(["ticker", "date"])
+    with conn:
+        create_prices_table(conn)
+        for start in range(0, len(data), batch_size):
+            conn.executemany(UPSERT_PRICES, price_rows(data.iloc[start:start + batch_size]))
+    return len(data)
+
+def get_last_dates(conn: sqlite3.Connection, tickers: Iterable[str]) -> Dict[str, Optional[str]]:
+    """The last stored date per ticker, None for tickers without prices"""
+    create_prices_table(conn)
+    last_dates = dict(conn.execute("SELECT ticker, MAX(date) FROM prices GROUP BY ticker"))
+    return {ticker: last_dates.get(ticker) for ticker in tickers}
+
+## Tickers are fetched one request each, in parallel. yf.download would batch
+## them, but keeps its results and errors in module globals that every call
+## resets, so concurrent downloads lose or steal each other's tickers.
+_download_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="yf-history")
+
+def _history(ticker: str, start_date: str, end_date: str) -> pd.DataFrame:
+    return yf.Ticker(ticker).history(start=start_date, end=end_date, auto_adjust=False, actions=False)
+
+def download_prices(tickers: List[str], start_date: str) -> pd.DataFrame:
+    """Downloads daily prices of several tickers, normalized to rows of the
+    prices table. Each ticker is its own ``Ticker.history`` request, and the
+    requests of concurrent calls share one pool of 16 threads. yfinance logs
+    instead of raising most per-ticker errors, so a ticker that came back empty
+    is reported with the reason 'no data returned'. The reasons are returned
+    in ``attrs["errors"]``."""
+    end_date = datetime.today().strftime("%Y-%m-%d")
+    futures = {ticker: _download_executor.submit(_history, ticker, start_date, end_date) for ticker in tickers}
+    frames, errors = [], {}
+    for ticker, future in futures.items():
+        try:
+            data = future.result()
+        except Exception as e:
+            errors[ticker] = f"download failed: {e}"
+            continue
+        data = data.dropna(how="all") if data is not None else None
+        if data is None or data.empty:
+            errors[ticker] = "no data returned"
+            continue
+        frames.append(normalize_prices(ticker, data))
+    prices = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PRICES_COLUMNS)
+    prices.attrs["errors"] = errors
+    return prices
+
+def update_prices(db_path: str, tickers: List[str]) -> int:
+    """Brings the prices of many tickers up to date. Tickers are downloaded
+    in one request per start date (for a nightly load, usually just one) and
+    written in a single transaction. The last stored day is fetched again, in
+    case it was stored before the close, and updated in place. The analytics
+    tables are refreshed afterwards.
+
+    Returns:
+        the number of rows written
+    """
+    tickers = [ticker.upper() for ticker in tickers]
+    conn = connect_db(db_path)
+    try:
+        by_start: Dict[str, List[str]] = {}
+        for ticker, last_date in get_last_dates(conn, tickers).items():
+            by_start.setdefault(last_date or get_start_date(), []).append(ticker)
+        frames = [download_prices(group, start_date) for start_date, group in by_start.items()]
+        rows = upsert_prices(conn, pd.concat(frames, ignore_index=True)) if frames else 0
+        refresh_analytics(conn, tickers)
+        return rows
+    finally:
+        conn.close()
+
 def create_db_table(
     db_path: str, 
-    company_name: str,
+    company_name: Union[str, List[str]],
 ):
-    engine, tables = connect_sql(db_path)
-    metadata_obj = MetaData()
-    table_name = get_ticker(company_name)
-    table = Table(
-        table_name,
-        metadata_obj,
-        Column("id", Integer, primary_key=True),
-        Column("date", DateTime),
-        Column("open", Float),
-        Column("high", Float),
-        Column("low", Float),
-        Column("close", Float),
-        Column("volume", Integer),
+    """Adds the daily prices of one or more companies to the prices table, or
+    the prices since their last stored date if they are already there"""
+    company_names = [company_name] if isinstance(company_name, str) else company_name
+    return update_prices(db_path, [get_ticker(name) for name in company_names])
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Moves per-ticker price tables into the prices table")
+    parser.add_argument("--db", default="./database/stocks.db", help="path of the stocks database")
+    parser.add_argument(
+        "--drop-ticker-tables", action="store_true",
+        help="drop the old per-ticker tables whose rows are all in the prices table",
     )
-    metadata_obj.create_all(engine)
-    conn = sqlite3.connect(db_path)
-    if table_name in tables: #update table
-        start_date = pd.read_sql(
-                f"""
-                SELECT Date FROM {table_name}
-                ORDER by Date DESC
-                LIMIT 1
-                """,
-                conn
-            )['Date'].values[0].split(" ")[0]
-        data = get_stock_data(ticker = table_name,
-                              start_date = start_date).reset_index()
-        data.to_sql(
-            table_name,
-            conn,
-            if_exists='append',
-            index = False
-        )
-    else:
-        data = get_stock_data(ticker = table_name).reset_index()
-        data.to_sql(
-            table_name,
-            conn,
-            index = False,
-            if_exists = "replace"
-        )
\ No newline at end of file
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    migrated = migrate_ticker_tables(args.db, drop_tables=args.drop_ticker_tables)
+    print(f"Migrated {len(migrated)} ticker tables")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#%%
+import logging
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+## Points per chart. Beyond this, extra points are invisible at chart width anyway.
+MAX_PLOT_POINTS = 2000
+
+## Columns that identify a series, e.g. the ticker in a long-format prices table
+SERIES_COLUMNS = ("ticker", "symbol", "unique_id")
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: picks ``n_out`` points of a series sorted
+    by ``x`` that preserve its visual shape (peaks and troughs are kept).
+    Returns their positions."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+    # The first and last points are always kept; the rest is split into buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+            avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+def _time_column(df: pd.DataFrame) -> Optional[pd.Series]:
+    """The time axis of a frame as datetimes: its DatetimeIndex, a datetime
+    column, or a text column named like a date (SQLite stores dates as text)"""
+    if isinstance(df.index, pd.DatetimeIndex):
+        return pd.Series(df.index, index=df.index)
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            return df[column]
+    for column in df.columns:
+        if str(column).lower() in ("date", "datetime", "ds", "time", "timestamp"):
+            parsed = pd.to_datetime(df[column], errors="coerce")
+            if parsed.notna().mean() > 0.9:
+                return parsed
+    return None
+
+def downsample_frame(df: pd.DataFrame, max_points: int = MAX_PLOT_POINTS) -> pd.DataFrame:
+    """Reduces a time series frame to about ``max_points`` rows for plotting.
+
+    Series (one per ticker if the frame has a ticker column) are downsampled
+    separately with LTTB on each numeric column. The rows picked for any column
+    are kept, along with each column's minimum and maximum. Frames that are
+    small or have no time axis are returned unchanged.
+    """
+    if len(df) <= max_points:
+        return df
+    time = _time_column(df)
+    numeric = list(df.select_dtypes("number").columns)
+    if time is None or not numeric:
+        return df
+    x = time.to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(np.float64)
+    series_column = next(
+        (column for column in df.columns if str(column).lower() in SERIES_COLUMNS), None
+    )
+    groups = (
+        [np.arange(len(df))] if series_column is None
+        else [np.asarray(positions) for positions in df.groupby(series_column, sort=False).indices.values()]
+    )
+    budget = max(3, max_points // (len(groups) * len(numeric)))
+    keep: List[np.ndarray] = []
+    for positions in groups:
+        positions = positions[np.argsort(x[positions], kind="stable")]
+        for column in numeric:
+            y = df[column].to_numpy(dtype=np.float64, na_value=np.nan)[positions]
+            keep.append(positions[lttb_indices(x[positions], y, budget)])
+            # LTTB favours the shape; the exact minimum and maximum are added explicitly
+            if np.isfinite(y).any():
+                keep.append(positions[[np.nanargmin(y), np.nanargmax(y)]])
+    rows = np.unique(np.concatenate(keep))
+    logger.debug("Downsampled a frame from %d to %d rows", len(df), len(rows))
+    return df.iloc[rows]
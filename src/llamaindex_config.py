@@ -23,4 +23,23 @@ text_splitter = SentenceSplitter(
     chunk_size = 1024,
     chunk_overlap = 20
 )
+# Investopedia articles behind the RAG tool and its prompt optimization
+links = [
+    "https://www.investopedia.com/terms/s/stockmarket.asp",
+    "https://www.investopedia.com/ask/answers/difference-between-options-and-futures/",
+    "https://www.investopedia.com/financial-edge/0411/5-essential-things-you-need-to-know-about-every-stock-you-buy.aspx",
+    "https://www.investopedia.com/articles/fundamental/04/063004.asp",
+    "https://www.investopedia.com/terms/t/technicalanalysis.asp",
+    "https://www.investopedia.com/terms/i/ichimoku-cloud.asp",
+    "https://www.investopedia.com/terms/a/aroon.asp",
+    "https://www.investopedia.com/terms/b/bollingerbands.asp",
+    "https://www.investopedia.com/articles/forex/05/macddiverge.asp",
+    "https://www.investopedia.com/terms/a/accumulationdistribution.asp",
+    "https://www.investopedia.com/terms/s/stochasticoscillator.asp",
+    "https://www.investopedia.com/terms/s/stochrsi.asp",
+    "https://www.investopedia.com/terms/p/price-earningsratio.asp",
+    "https://www.investopedia.com/terms/p/price-to-bookratio.asp",
+    "https://www.investopedia.com/terms/p/price-to-salesratio.asp",
+    "https://www.investopedia.com/terms/q/quickratio.asp"
+]
 # %%
@@ -0,0 +1,232 @@
+#%%
+"""Local symbol master for resolving company names to tickers.
+
+    python src/symbol_index.py --import sp500.csv
+    python src/symbol_index.py --query "berkshire hathaway"
+
+The index is seeded from constituents CSVs and grows with every name that
+``db_utils.get_ticker`` has to look up on Yahoo Finance.
+"""
+import os
+import re
+import sys
+import json
+import bisect
+import argparse
+import logging
+import tempfile
+import threading
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SYMBOL_INDEX_PATH = os.getenv("SYMBOL_INDEX_PATH", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database", "symbols.json"
+))
+
+## Words that don't tell companies apart, e.g. 'Apple Inc.' is found as 'apple'
+_STOP_WORDS = {
+    "the", "inc", "incorporated", "corp", "corporation", "co", "company", "ltd",
+    "limited", "plc", "llc", "lp", "sa", "ag", "nv", "se", "holdings", "holding",
+}
+
+class SymbolRecord(NamedTuple):
+    """An entry of the symbol master.
+
+    Args:
+        ticker: Yahoo Finance symbol
+        name: company name
+        exchange: listing exchange, if known
+        aliases: other names the company goes by, e.g. 'Google' for GOOGL
+    """
+    ticker: str
+    name: str
+    exchange: str = ""
+    aliases: Tuple[str, ...] = ()
+
+def normalize_name(name: str) -> str:
+    """Lowercases a company name and drops punctuation, share classes and legal suffixes"""
+    name = re.sub(r"\bclass [a-z]\b", " ", name.lower().replace("&", " and "))
+    words = re.sub(r"[^a-z0-9]+", " ", name).split()
+    return " ".join(word for word in words if word not in _STOP_WORDS) or " ".join(words)
+
+def _trigrams(key: str) -> Set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SymbolIndex:
+    """Resolves company names to tickers locally.
+
+    ``resolve`` only accepts exact tickers, names and aliases. ``search`` also
+    suggests prefix matches ('berkshire' for Berkshire Hathaway) and trigram
+    matches that tolerate typos ('nvidea'). The symbol master is kept as JSON
+    at ``path`` and grows as names that had to be looked up online are added.
+
+    Args:
+        path: JSON file holding the symbol master
+        min_similarity: Dice coefficient of trigrams needed for a fuzzy suggestion
+    """
+
+    def __init__(self, path: str = SYMBOL_INDEX_PATH, min_similarity: float = 0.5):
+        self.path = path
+        self.min_similarity = min_similarity
+        self.records: Dict[str, SymbolRecord] = {}
+        self._exact: Dict[str, str] = {}
+        self._keys: List[str] = []
+        self._trigram_keys: Dict[str, Set[str]] = {}
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logger.exception("Could not read the symbol index at %s", self.path)
+            return
+        for entry in entries:
+            self.add(SymbolRecord(
+                ticker = entry["ticker"],
+                name = entry["name"],
+                exchange = entry.get("exchange", ""),
+                aliases = tuple(entry.get("aliases", ())),
+            ))
+
+    def save(self):
+        """Writes the symbol master to a temporary file that then replaces ``path``.
+        Saves are serialized, so the last one always writes the latest entries,
+        and lookups aren't blocked while the file is written."""
+        with self._save_lock:
+            with self._lock:
+                entries = [record._asdict() for record in sorted(self.records.values())]
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as file:
+                json.dump(entries, file, indent=1)
+            try:
+                os.replace(file.name, self.path)
+            except OSError:
+                os.remove(file.name)
+                raise
+
+    def add(self, record: SymbolRecord):
+        """Adds or extends an entry. Aliases of an existing ticker are merged."""
+        record = record._replace(ticker=record.ticker.strip().upper())
+        with self._lock:
+            existing = self.records.get(record.ticker)
+            if existing is not None:
+                record = existing._replace(
+                    exchange = existing.exchange or record.exchange,
+                    aliases = tuple(dict.fromkeys(
+                        existing.aliases + ((record.name,) if record.name != existing.name else ()) + record.aliases
+                    )),
+                )
+            self.records[record.ticker] = record
+            for name in (record.ticker, record.name, *record.aliases):
+                key = normalize_name(name)
+                if not key or key in self._exact:
+                    continue
+                self._exact[key] = record.ticker
+                bisect.insort(self._keys, key)
+                for trigram in _trigrams(key):
+                    self._trigram_keys.setdefault(trigram, set()).add(key)
+
+    def import_csv(self, path: str) -> int:
+        """Adds the companies of a constituents CSV with Symbol/Ticker and
+        Name/Security/Company columns (and optionally Exchange)"""
+        df = pd.read_csv(path)
+        columns = {str(c).strip().lower(): c for c in df.columns}
+        ticker = next(columns[c] for c in ("symbol", "ticker") if c in columns)
+        name = next(columns[c] for c in ("name", "security", "company", "company name") if c in columns)
+        df = df.dropna(subset=[ticker, name])
+        exchanges = df[columns["exchange"]].fillna("") if "exchange" in columns else [""] * len(df)
+        for symbol, company, exchange in zip(df[ticker], df[name], exchanges):
+            # Yahoo uses dashes for share classes, e.g. BRK-B
+            self.add(SymbolRecord(str(symbol).replace(".", "-"), str(company), str(exchange)))
+        return len(df)
+
+    def _prefix_matches(self, key: str, limit: int = 50) -> List[str]:
+        start = bisect.bisect_left(self._keys, key)
+        matches = []
+        for candidate in self._keys[start:start + limit]:
+            if not candidate.startswith(key):
+                break
+            matches.append(candidate)
+        return matches
+
+    def _similar(self, key: str, limit: int) -> List[Tuple[str, float]]:
+        """Keys sharing the most trigrams with ``key``, by Dice coefficient"""
+        trigrams = _trigrams(key)
+        shared = Counter(
+            candidate for trigram in trigrams for candidate in self._trigram_keys.get(trigram, ())
+        )
+        similar = [
+            (candidate, 2 * count / (len(trigrams) + len(_trigrams(candidate))))
+            for candidate, count in shared.most_common(limit)
+        ]
+        return sorted(similar, key=lambda item: -item[1])
+
+    def search(self, query: str, limit: int = 5) -> List[Tuple[SymbolRecord, float]]:
+        """Best matching companies for a query, with scores between 0 and 1"""
+        key = normalize_name(query)
+        if not key:
+            return []
+        with self._lock:
+            scores: Dict[str, float] = {}
+            if query.strip().upper() in self.records:
+                scores[query.strip().upper()] = 1.0
+            if key in self._exact:
+                scores.setdefault(self._exact[key], 1.0)
+            if len(key) >= 3:
+                for candidate in self._prefix_matches(key):
+                    ticker = self._exact[candidate]
+                    scores[ticker] = max(scores.get(ticker, 0.0), 0.9 * len(key) / len(candidate))
+            for candidate, similarity in self._similar(key, limit * 4):
+                if similarity < self.min_similarity:
+                    continue
+                ticker = self._exact[candidate]
+                scores[ticker] = max(scores.get(ticker, 0.0), 0.85 * similarity)
+            ranked = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+            return [(self.records[ticker], round(score, 3)) for ticker, score in ranked]
+
+    def resolve(self, query: str) -> Optional[SymbolRecord]:
+        """The company a query names exactly (by ticker, name or alias), or None.
+        Prefix and fuzzy matches are never resolved, since they easily point at
+        the wrong company ('Intel' is a prefix of 'Intellia'); they are only
+        offered as suggestions by ``search``."""
+        key = normalize_name(query)
+        with self._lock:
+            if query.strip().upper() in self.records:
+                return self.records[query.strip().upper()]
+            if key in self._exact:
+                return self.records[self._exact[key]]
+        return None
+
+## One index per process
+symbol_index = SymbolIndex()
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", default=SYMBOL_INDEX_PATH, help="path of the symbol index")
+    parser.add_argument("--import", dest="csv_files", nargs="*", default=[], help="constituents CSVs to add")
+    parser.add_argument("--query", help="company name to look up")
+    args = parser.parse_args(argv)
+
+    index = symbol_index if args.index == symbol_index.path else SymbolIndex(args.index)
+    if args.csv_files:
+        for path in args.csv_files:
+            print(f"Added {index.import_csv(path)} companies from {path}")
+        index.save()
+    if args.query:
+        for record, score in index.search(args.query):
+            print(f"{record.ticker:<8} {score:.3f}  {record.name} ({record.exchange or '-'})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
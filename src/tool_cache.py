@@ -0,0 +1,163 @@
+#%%
+import json
+import asyncio
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+from concurrent.futures import Future
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from llama_index.core.tools import FunctionTool
+
+from cache_utils import TTLCache, register_cache
+from tracing import set_span_attributes
+
+logger = logging.getLogger(__name__)
+
+## Arguments holding tickers are canonicalized so 'aapl' and 'AAPL ' share a cache entry
+TICKER_ARGS = ("ticker", "tickers", "symbol", "symbols")
+
+_session_id: ContextVar[Optional[str]] = ContextVar("tool_session_id", default=None)
+
+def set_tool_session(session_id: Optional[str]):
+    """Sets the chat session that tool calls in the current context belong to"""
+    _session_id.set(session_id)
+
+def get_tool_session() -> Optional[str]:
+    return _session_id.get()
+
+def canonicalize_args(fn: Callable, args: tuple, kwargs: dict) -> Tuple[tuple, dict]:
+    """Binds a call to the signature of ``fn`` with its defaults filled in and
+    uppercases tickers. Returns the arguments to call ``fn`` with."""
+    try:
+        bound = inspect.signature(fn).bind(*args, **kwargs)
+    except TypeError:
+        return args, kwargs
+    bound.apply_defaults()
+    for name in TICKER_ARGS:
+        value = bound.arguments.get(name)
+        if isinstance(value, str):
+            bound.arguments[name] = value.strip().upper()
+        elif isinstance(value, (list, tuple)):
+            bound.arguments[name] = [str(v).strip().upper() for v in value]
+    return bound.args, bound.kwargs
+
+class ToolCallCache:
+    """Memoizes tool results in a global LRU shared by every session, and in a
+    per-session LRU so a session keeps seeing its own results after they have
+    been evicted from the global cache. Both expire after ``ttl`` seconds so
+    market data is refreshed.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 512,
+        session_max_size: int = 128,
+        max_sessions: int = 64,
+        ttl: Optional[float] = 15 * 60,
+    ):
+        self.global_cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._sessions = TTLCache(max_size=max_sessions, ttl=None)
+        self.session_max_size = session_max_size
+        self.ttl = ttl
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        register_cache("tool_calls", self)
+
+    def _session_cache(self) -> Optional[TTLCache]:
+        session_id = _session_id.get()
+        if session_id is None:
+            return None
+        cache = self._sessions.get(session_id)
+        if cache is None:
+            cache = TTLCache(max_size=self.session_max_size, ttl=self.ttl)
+            self._sessions.set(session_id, cache)
+        return cache
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        session = self._session_cache()
+        if session is not None and key in session:
+            self.hits += 1
+            return True, session.get(key)
+        if key in self.global_cache:
+            value = self.global_cache.get(key)
+            if session is not None:
+                session.set(key, value)
+            self.hits += 1
+            return True, value
+        self.misses += 1
+        return False, None
+
+    def set(self, key: Hashable, value: Any):
+        self.global_cache.set(key, value)
+        session = self._session_cache()
+        if session is not None:
+            session.set(key, value)
+
+    def clear(self):
+        self.global_cache.clear()
+        self._sessions.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.global_cache),
+            "sessions": len(self._sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+## One cache per process, shared by every agent's tools
+tool_call_cache = ToolCallCache()
+
+def memoize_tool(tool: FunctionTool, cache: ToolCallCache = tool_call_cache) -> FunctionTool:
+    """Returns a copy of ``tool`` whose results are memoized on its canonicalized
+    arguments. Concurrent calls with the same arguments share one execution."""
+    fn = tool.fn
+    name = getattr(fn, "__qualname__", tool.metadata.name)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args, kwargs = canonicalize_args(fn, args, kwargs)
+        key = (name, json.dumps([args, kwargs], sort_keys=True, default=str))
+        with cache._lock:
+            future = cache._inflight.get(key)
+            owner = future is None
+            if owner:
+                hit, value = cache.get(key)
+                if hit:
+                    logger.debug("Tool cache hit for %s", key)
+                    set_span_attributes(cache="hit")
+                    return value
+                future = cache._inflight[key] = Future()
+            else:
+                cache.hits += 1
+        if not owner:
+            set_span_attributes(cache="inflight")
+            return future.result()
+        set_span_attributes(cache="miss")
+        try:
+            value = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            cache.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            with cache._lock:
+                cache._inflight.pop(key, None)
+
+    async def async_wrapper(*args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, contextvars.copy_context().run, functools.partial(wrapper, *args, **kwargs)
+        )
+
+    return FunctionTool(fn=wrapper, metadata=tool.metadata, async_fn=async_wrapper)
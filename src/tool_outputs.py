@@ -0,0 +1,133 @@
+#%%
+import hashlib
+import functools
+import pandas as pd
+from typing import Any, List, Optional
+
+from llama_index.core.tools import FunctionTool
+
+from artifact_store import artifact_store
+
+## Frames up to this size are returned to the agent in full
+MAX_FULL_ROWS = 20
+MAX_FULL_CHARS = 2000
+## Size of the head/tail previews and the cap on a whole summary
+PREVIEW_ROWS = 5
+MAX_SUMMARY_CHARS = 4000
+
+def _frame_key(df: pd.DataFrame) -> str:
+    """Content hash of a frame. ``str(df)`` is truncated by pandas, so it can't be used."""
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(str(list(df.columns)).encode())
+    return digest.hexdigest()
+
+def _to_frame(obj: Any) -> Optional[pd.DataFrame]:
+    if isinstance(obj, pd.DataFrame):
+        return obj
+    if isinstance(obj, pd.Series):
+        return obj.to_frame()
+    if isinstance(obj, pd.Index):
+        return obj.to_frame(index=False)
+    return None
+
+def _summarize_frame(df: pd.DataFrame) -> str:
+    if len(df) <= MAX_FULL_ROWS:
+        text = df.to_string()
+        if len(text) <= MAX_FULL_CHARS:
+            return text
+
+    artifact_id = artifact_store.put(df, key=_frame_key(df))
+    lines = [f"Table with {len(df)} rows and {len(df.columns)} columns: {', '.join(map(str, df.columns))}"]
+    if isinstance(df.index, pd.DatetimeIndex) and len(df):
+        lines.append(f"Dates from {df.index.min().date()} to {df.index.max().date()}")
+    lines += ["First rows:", df.head(PREVIEW_ROWS).to_string(), "Last rows:", df.tail(PREVIEW_ROWS).to_string()]
+
+    numeric = df.select_dtypes("number")
+    numeric = numeric.loc[:, numeric.notna().any()]
+    if not numeric.empty:
+        lines += ["Summary statistics:", numeric.describe().round(4).to_string()]
+        lines.append("Extrema:")
+        for column in numeric.columns:
+            series = numeric[column]
+            lines.append(
+                f"  {column}: max {series.max():.4g} at {series.idxmax()}, "
+                f"min {series.min():.4g} at {series.idxmin()}"
+            )
+
+    text = "\n".join(lines)
+    if len(text) > MAX_SUMMARY_CHARS:
+        text = text[:MAX_SUMMARY_CHARS] + "\n..."
+    return text + "\n" + artifact_store.reference(
+        artifact_id, "full table, page through it with the read_artifact tool"
+    )
+
+def serialize_output(obj: Any) -> str:
+    """Turns a tool result into text for the agent's prompt. Small tables are
+    returned as they are; large ones become a size-capped summary (head, tail,
+    statistics and extrema) plus a handle to the full table in the artifact store."""
+    frame = _to_frame(obj)
+    if frame is not None:
+        return _summarize_frame(frame)
+    if isinstance(obj, (tuple, list)) and any(_to_frame(item) is not None for item in obj):
+        return "\n\n".join(serialize_output(item) for item in obj)
+    if isinstance(obj, dict) and any(_to_frame(item) is not None for item in obj.values()):
+        return "\n\n".join(f"{key}:\n{serialize_output(item)}" for key, item in obj.items())
+    return str(obj)
+
+def compact_tool(tool: FunctionTool) -> FunctionTool:
+    """Returns a copy of ``tool`` whose output goes through ``serialize_output``"""
+    fn = tool.fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return serialize_output(fn(*args, **kwargs))
+
+    return FunctionTool(fn=wrapper, metadata=tool.metadata)
+
+#%%
+def read_artifact(
+    artifact_id: str,
+    start_row: int = 0,
+    n_rows: int = 50,
+    columns: Optional[List[str]] = None,
+    start_char: int = 0,
+) -> str:
+    """Reads rows of a table, or a page of a text, that a tool stored as an
+    artifact, e.g. [artifact 'abc123': full table ...]. Use it to look at parts
+    of a large table or text that are not in its summary.
+
+    Args:
+        artifact_id: the id quoted in the artifact reference
+        start_row: first row of a table to return. Negative values count from the end
+        n_rows: number of rows to return, at most 200
+        columns: columns to return. All columns if not given
+        start_char: first character of a text to return, 4000 characters are
+            returned per page. Negative values count from the end
+    """
+    artifact = artifact_store.get(artifact_id)
+    if artifact is None:
+        return f"Artifact '{artifact_id}' was not found. It may have expired; call the original tool again."
+    df = _to_frame(artifact)
+    if df is None:
+        text = str(artifact)
+        if start_char < 0:
+            start_char = max(len(text) + start_char, 0)
+        page = text[start_char:start_char + MAX_SUMMARY_CHARS]
+        end_char = start_char + len(page)
+        more = f"\n... (continue with start_char={end_char})" if end_char < len(text) else ""
+        return f"Characters {start_char} to {end_char} of {len(text)}:\n{page}{more}"
+    if columns:
+        missing = [column for column in columns if column not in df.columns]
+        if missing:
+            return f"Unknown columns {missing}. Available columns: {', '.join(map(str, df.columns))}"
+        df = df[columns]
+    if start_row < 0:
+        start_row = max(len(df) + start_row, 0)
+    page = df.iloc[start_row:start_row + min(n_rows, 200)]
+    text = page.to_string()
+    if len(text) > MAX_SUMMARY_CHARS * 2:
+        text = text[:MAX_SUMMARY_CHARS * 2] + "\n... (ask for fewer rows or columns)"
+    return f"Rows {start_row} to {start_row + len(page) - 1} of {len(df)}:\n{text}"
+
+def get_artifact_tools() -> List[FunctionTool]:
+    return [FunctionTool.from_defaults(read_artifact)]
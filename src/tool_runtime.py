@@ -0,0 +1,196 @@
+#%%
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional, Set
+
+from llama_index.core.tools import FunctionTool
+
+from tool_cache import get_tool_session
+from tracing import approx_tokens, span
+
+logger = logging.getLogger(__name__)
+
+class ToolTimeoutError(TimeoutError):
+    """Raised when a tool misses its deadline. Agents see the message as the tool's output."""
+
+class ToolRuntime:
+    """Runs tools in a bounded thread pool with a deadline per tool.
+
+    Sync tools run on the pool instead of the calling thread, and wrapped tools
+    get an async variant that awaits the pool without blocking the event loop.
+    A tool that misses its deadline raises ``ToolTimeoutError``, which the
+    llama-index agents report back to the LLM as a tool error. Calls are tracked
+    per chat session so ``cancel_session`` can drop queued calls and cancel the
+    agents awaiting running ones. Threads that are already running a tool
+    can't be interrupted; they finish in the background and their result is dropped.
+
+    Such abandoned calls still hold a worker. A session holding
+    ``max_abandoned_per_session`` of them gets no new calls until they finish,
+    and once half the pool is abandoned, new calls go to a fresh pool while the
+    old one winds down, so hung tools can't starve the other sessions.
+
+    Args:
+        max_workers: size of the thread pool shared by all tools
+        default_timeout: deadline in seconds for tools without their own
+        timeouts: deadline in seconds per tool name
+        max_abandoned_per_session: abandoned calls a session may hold before its new calls are refused
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 16,
+        default_timeout: Optional[float] = 60,
+        timeouts: Optional[Dict[str, float]] = None,
+        max_abandoned_per_session: int = 4,
+    ):
+        self.max_workers = max_workers
+        self._executor = self._new_executor()
+        self.default_timeout = default_timeout
+        self.timeouts = dict(timeouts or {})
+        self.max_abandoned_per_session = max_abandoned_per_session
+        self._inflight: Dict[Optional[str], Set[Any]] = defaultdict(set)
+        self._abandoned: Counter = Counter()
+        self._pool_abandoned = 0
+        self._pool_generation = 0
+        self._lock = threading.Lock()
+
+    def _new_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers = self.max_workers,
+            thread_name_prefix = "tool"
+        )
+
+    def timeout_for(self, name: str) -> Optional[float]:
+        return self.timeouts.get(name, self.default_timeout)
+
+    def _submit(self, session_id: Optional[str], fn: Callable, args: tuple, kwargs: dict) -> Future:
+        with self._lock:
+            if self._abandoned[session_id] >= self.max_abandoned_per_session:
+                raise ToolTimeoutError(
+                    f"{self._abandoned[session_id]} earlier tool calls of this chat are still running "
+                    "past their deadline. Try again once they have finished."
+                )
+            executor = self._executor
+        # Tools see the caller's context variables, e.g. the chat session
+        context = contextvars.copy_context()
+        return executor.submit(context.run, fn, *args, **kwargs)
+
+    def _abandon(self, session_id: Optional[str], future: Future):
+        """Accounts for a call whose caller gave up while its thread still runs"""
+        with self._lock:
+            self._abandoned[session_id] += 1
+            self._pool_abandoned += 1
+            generation = self._pool_generation
+            if self._pool_abandoned * 2 >= self.max_workers:
+                logger.warning(
+                    "%d tool threads are still running past their deadline, starting a new pool",
+                    self._pool_abandoned,
+                )
+                # Its live threads still run the calls already queued on it
+                self._executor.shutdown(wait=False)
+                self._executor = self._new_executor()
+                self._pool_abandoned = 0
+                self._pool_generation += 1
+        future.add_done_callback(lambda _: self._release(session_id, generation))
+
+    def _release(self, session_id: Optional[str], generation: int):
+        with self._lock:
+            self._abandoned[session_id] -= 1
+            if self._abandoned[session_id] <= 0:
+                del self._abandoned[session_id]
+            if generation == self._pool_generation:
+                self._pool_abandoned -= 1
+
+    def _track(self, session_id: Optional[str], future: Any):
+        with self._lock:
+            self._inflight[session_id].add(future)
+
+    def _untrack(self, session_id: Optional[str], future: Any):
+        with self._lock:
+            self._inflight[session_id].discard(future)
+            if not self._inflight[session_id]:
+                del self._inflight[session_id]
+
+    def run(self, name: str, fn: Callable, *args, **kwargs) -> Any:
+        """Runs ``fn`` on the pool and waits for it up to the tool's deadline"""
+        with span("tool", tool=name) as tool_span:
+            result = self._run(name, fn, args, kwargs)
+            tool_span.set_attribute("output_tokens", approx_tokens(result))
+            return result
+
+    def _run(self, name: str, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        session_id = get_tool_session()
+        future = self._submit(session_id, fn, args, kwargs)
+        self._track(session_id, future)
+        timeout = self.timeout_for(name)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning("Tool '%s' timed out after %ss", name, timeout)
+            raise ToolTimeoutError(
+                f"The tool '{name}' did not finish within {timeout} seconds and was stopped. "
+                "Try again with a narrower request."
+            ) from None
+        finally:
+            self._untrack(session_id, future)
+            if not future.done():
+                self._abandon(session_id, future)
+
+    async def arun(self, name: str, fn: Callable, *args, **kwargs) -> Any:
+        """Async variant of ``run``. Cancelling the caller cancels the call."""
+        with span("tool", tool=name) as tool_span:
+            result = await self._arun(name, fn, args, kwargs)
+            tool_span.set_attribute("output_tokens", approx_tokens(result))
+            return result
+
+    async def _arun(self, name: str, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        session_id = get_tool_session()
+        pool_future = self._submit(session_id, fn, args, kwargs)
+        future = asyncio.wrap_future(pool_future)
+        self._track(session_id, future)
+        timeout = self.timeout_for(name)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Tool '%s' timed out after %ss", name, timeout)
+            raise ToolTimeoutError(
+                f"The tool '{name}' did not finish within {timeout} seconds and was stopped. "
+                "Try again with a narrower request."
+            ) from None
+        finally:
+            self._untrack(session_id, future)
+            if not pool_future.done():
+                self._abandon(session_id, pool_future)
+
+    def cancel_session(self, session_id: Optional[str]) -> int:
+        """Cancels every tool call of a chat session. Returns how many were cancelled."""
+        with self._lock:
+            futures = list(self._inflight.pop(session_id, ()))
+        cancelled = 0
+        for future in futures:
+            if isinstance(future, asyncio.Future):
+                # asyncio futures must be cancelled on their own loop
+                future.get_loop().call_soon_threadsafe(future.cancel)
+                cancelled += 1
+            elif future.cancel():
+                cancelled += 1
+        if cancelled:
+            logger.info("Cancelled %d tool calls of session %s", cancelled, session_id)
+        return cancelled
+
+    def wrap(self, tool: FunctionTool) -> FunctionTool:
+        """Returns a copy of ``tool`` that runs on the pool under its deadline"""
+        name, fn = tool.metadata.name, tool.fn
+
+        def wrapper(*args, **kwargs):
+            return self.run(name, fn, *args, **kwargs)
+
+        async def async_wrapper(*args, **kwargs):
+            return await self.arun(name, fn, *args, **kwargs)
+
+        return FunctionTool(fn=wrapper, metadata=tool.metadata, async_fn=async_wrapper)
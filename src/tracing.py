@@ -0,0 +1,224 @@
+#%%
+"""Lightweight tracing for the agent and tool pipeline.
+
+Spans are nested through a context variable, so a tool call made while an agent
+is replying becomes a child of that agent's span, also across the thread pools
+the tools run on (they run with a copy of the caller's context). Finished spans
+are kept in a small in-memory buffer and mirrored to OpenTelemetry when
+``opentelemetry-api`` is installed, so an OTLP exporter configured for the
+process picks them up as well. Set ``TRACE_FILE`` (e.g. ``./traces/spans.jsonl``)
+to also append them as JSON lines to a file, which is rotated once it reaches
+``TRACE_FILE_MAX_MB`` megabytes (default 50).
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+def approx_tokens(text: Any) -> int:
+    """Rough token count (~4 characters per token), good enough to compare stages"""
+    return len(str(text or "")) // 4
+
+def message_text(message: Dict) -> str:
+    """Text of a chat message, whose content may be a list of parts"""
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        content = " ".join(
+            part.get("text", "") for part in content if isinstance(part, dict)
+        )
+    return str(content)
+
+class Span:
+    """A timed stage with attributes. Use ``Tracer.span`` to create one."""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes",
+                 "start", "end", "status", "_perf_start", "_otel_span")
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.status = "ok"
+        self._perf_start = time.perf_counter()
+        self._otel_span = None
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        return None if self.end is None else round((self.end - self.start) * 1000, 3)
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+        if self._otel_span is not None and isinstance(value, (str, bool, int, float)):
+            self._otel_span.set_attribute(key, value)
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def add(self, key: str, amount: float = 1):
+        """Increments a numeric attribute, e.g. token counts accumulated over several calls"""
+        self.set_attribute(key, self.attributes.get(key, 0) + amount)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+class JsonLinesExporter:
+    """Appends finished spans to a file, one JSON object per line. A full file
+    is renamed to ``<path>.1`` (and older ones to ``.2``, ...) and a new one started.
+
+    Args:
+        path: file to append to
+        max_bytes: size at which the file is rotated, never if None
+        backups: number of rotated files kept
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = 50 * 2**20, backups: int = 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._size = 0
+
+    def export(self, span: Span):
+        line = (json.dumps(span.to_dict(), default=str) + "\n").encode("utf-8")
+        with self._lock:
+            if self.max_bytes is not None and self._size and self._size + len(line) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as file:
+                file.write(line)
+            self._size += len(line)
+
+class Tracer:
+    """Creates spans and hands finished ones to its exporters.
+
+    Args:
+        exporters: objects with an ``export(span)`` method
+        buffer_size: number of recent spans kept in memory for ``recent``
+    """
+
+    def __init__(self, exporters: Optional[List[Any]] = None, buffer_size: int = 2048):
+        self.exporters = list(exporters or [])
+        self._recent = deque(maxlen=buffer_size)
+        self._current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+        self._otel = otel_trace.get_tracer(__name__) if otel_trace is not None else None
+
+    def current(self) -> Optional[Span]:
+        return self._current.get()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """Times the enclosed block as a child of the current span"""
+        span = Span(name, self._current.get(), attributes)
+        token = self._current.set(span)
+        otel_cm = None
+        if self._otel is not None:
+            otel_cm = self._otel.start_as_current_span(name)
+            span._otel_span = otel_cm.__enter__()
+            span.set_attributes(**attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+            span.set_attribute("error", f"{type(e).__name__}: {e}"[:500])
+            raise
+        finally:
+            span.end = span.start + time.perf_counter() - span._perf_start
+            self._current.reset(token)
+            if otel_cm is not None:
+                otel_cm.__exit__(None, None, None)
+            self._finish(span)
+
+    def _finish(self, span: Span):
+        self._recent.append(span)
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                logger.exception("Could not export span '%s'", span.name)
+
+    def recent(self, name: Optional[str] = None) -> List[Span]:
+        """Recently finished spans, optionally filtered by name"""
+        return [span for span in list(self._recent) if name is None or span.name == name]
+
+    def traced(self, name: Optional[str] = None, **attributes) -> Callable:
+        """Decorator that wraps every call of a sync or async function in a span"""
+        def decorator(fn: Callable) -> Callable:
+            span_name = name or fn.__qualname__
+
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(span_name, **attributes):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name, **attributes):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+def _default_exporters() -> List[Any]:
+    path = os.getenv("TRACE_FILE", "")
+    if not path:
+        return []
+    try:
+        return [JsonLinesExporter(path, max_bytes=int(float(os.getenv("TRACE_FILE_MAX_MB", 50)) * 2**20))]
+    except OSError:
+        logger.warning("Cannot write traces to %s, keeping them in memory only", path)
+        return []
+
+## One tracer per process
+tracer = Tracer(exporters=_default_exporters())
+span = tracer.span
+traced = tracer.traced
+
+def current_span() -> Optional[Span]:
+    return tracer.current()
+
+def set_span_attributes(**attributes):
+    """Sets attributes on the current span, if there is one"""
+    current = tracer.current()
+    if current is not None:
+        current.set_attributes(**attributes)
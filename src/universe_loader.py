@@ -0,0 +1,259 @@
+#%%
+"""Loads the prices of a universe of tickers into the stocks database.
+
+    python src/universe_loader.py --tickers AAPL MSFT NVDA
+    python src/universe_loader.py --file sp500.csv --workers 8 --rate 4
+
+``--file`` takes a text file with one ticker per line, or an index constituents
+CSV with a Symbol or Ticker column. Batches are fetched by a pool of workers
+under a shared rate limit (the tickers of a batch are separate requests, run in
+parallel on a pool shared by all batches), and a single writer thread upserts
+each batch as it arrives, so SQLite never sees competing writers. The analytics tables are
+refreshed once all batches are written.
+"""
+import os
+import sys
+import time
+import queue
+import logging
+import argparse
+import threading
+from datetime import datetime
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Set
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from db_utils import connect_db, download_prices, get_last_dates, get_start_date, upsert_prices
+from analytics_tables import refresh_analytics
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    """Spaces calls out to at most ``rate`` per second across threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait, self._next = max(0.0, self._next - now), max(self._next, now) + self.interval
+        if wait:
+            time.sleep(wait)
+
+@dataclass
+class LoadReport:
+    """Outcome of a universe load"""
+    tickers: int = 0
+    loaded: int = 0
+    rows: int = 0
+    seconds: float = 0.0
+    failures: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def tickers_per_second(self) -> float:
+        return self.loaded / self.seconds if self.seconds else 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        lines = [
+            f"Loaded {self.loaded}/{self.tickers} tickers, {self.rows:,} rows in {self.seconds:.1f}s "
+            f"({self.tickers_per_second:.1f} tickers/s, {self.rows_per_second:,.0f} rows/s)"
+        ]
+        lines += [f"  {ticker}: {error}" for ticker, error in sorted(self.failures.items())]
+        return "\n".join(lines)
+
+def read_tickers(path: str) -> List[str]:
+    """Tickers from a text file (one per line) or a constituents CSV"""
+    if path.lower().endswith(".csv"):
+        df = pd.read_csv(path)
+        column = next((c for c in df.columns if str(c).strip().lower() in ("symbol", "ticker")), df.columns[0])
+        tickers = df[column].dropna().astype(str).tolist()
+    else:
+        with open(path) as file:
+            tickers = [line.split("#")[0] for line in file]
+    # Yahoo uses dashes for share classes, e.g. BRK-B
+    return list(dict.fromkeys(t.strip().upper().replace(".", "-") for t in tickers if t.strip()))
+
+def _writer(db_path: str, batches: queue.Queue, report: LoadReport, written: Set[str],
+            report_lock: threading.Lock, stopped: threading.Event):
+    """Upserts batches from the queue until it receives None. If it can't go on
+    (e.g. the database can't be opened) it sets ``stopped``, so that fetchers
+    stop handing it batches."""
+    try:
+        conn = connect_db(db_path)
+    except Exception:
+        logger.exception("Could not open %s", db_path)
+        stopped.set()
+        return
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            tickers = batch["ticker"].unique()
+            try:
+                rows = upsert_prices(conn, batch)
+            except Exception as e:
+                logger.exception("Could not write a batch")
+                with report_lock:
+                    for ticker in tickers:
+                        report.failures[ticker] = f"write failed: {e}"
+                continue
+            with report_lock:
+                report.rows += rows
+                written.update(tickers)
+    except Exception:
+        logger.exception("The prices writer stopped")
+        stopped.set()
+    finally:
+        conn.close()
+
+def load_universe(
+    db_path: str,
+    tickers: List[str],
+    max_workers: int = 8,
+    requests_per_second: float = 4,
+    batch_size: int = 20,
+    max_retries: int = 2,
+) -> LoadReport:
+    """Downloads the missing prices of every ticker and writes them to the database.
+
+    Args:
+        db_path: path of the stocks database
+        tickers: tickers to load; ones already in the database are brought up to date
+        max_workers: batches in flight. Their ticker requests share
+            ``db_utils``' download pool of 16 threads
+        requests_per_second: limit on batch downloads started per second across workers
+        batch_size: tickers per batch, each fetched with its own request
+        max_retries: retries of a failed download or of the tickers missing from
+            it, with exponential backoff
+    """
+    start = time.perf_counter()
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    report = LoadReport(tickers=len(tickers))
+    conn = connect_db(db_path)
+    try:
+        last_dates = get_last_dates(conn, tickers)
+    finally:
+        conn.close()
+    today = datetime.today().strftime("%Y-%m-%d")
+    by_start: Dict[str, List[str]] = {}
+    for ticker, last_date in last_dates.items():
+        if last_date is not None and last_date >= today: # nothing new to download yet
+            report.loaded += 1
+            continue
+        by_start.setdefault(last_date or get_start_date(), []).append(ticker)
+    jobs = [
+        (start_date, group[i:i + batch_size])
+        for start_date, group in by_start.items()
+        for i in range(0, len(group), batch_size)
+    ]
+
+    limiter = RateLimiter(requests_per_second)
+    report_lock = threading.Lock()
+    written: Set[str] = set()
+    stopped = threading.Event()
+    batches: queue.Queue = queue.Queue(maxsize=max_workers * 2)
+    writer = threading.Thread(
+        target = _writer,
+        args = (db_path, batches, report, written, report_lock, stopped),
+        name = "prices-writer",
+    )
+    writer.start()
+
+    def deliver(item) -> bool:
+        """Queues an item for the writer, unless the writer has stopped"""
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(start_date: str, batch: List[str]):
+        # Tickers missing from a download are retried, and reported as failures
+        # once the retries run out
+        pending, reasons = list(batch), {}
+        for attempt in range(max_retries + 1):
+            if stopped.is_set():
+                return
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            limiter.wait()
+            try:
+                data = download_prices(pending, start_date)
+            except Exception as e:
+                reasons.update({ticker: f"download failed: {e}" for ticker in pending})
+                continue
+            errors = data.attrs.get("errors", {})
+            pending = [ticker for ticker in pending if ticker in errors]
+            reasons.update({ticker: errors[ticker] for ticker in pending})
+            if len(data) and not deliver(data):
+                return
+            if not pending:
+                return
+        with report_lock:
+            for ticker in pending:
+                report.failures[ticker] = reasons[ticker]
+
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prices")
+    try:
+        futures = [pool.submit(fetch, start_date, batch) for start_date, batch in jobs]
+        for future in as_completed(futures):
+            future.result()
+            if stopped.is_set():
+                break
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        deliver(None)
+        writer.join()
+    for start_date, batch in jobs:
+        for ticker in batch:
+            if ticker not in written and ticker not in report.failures:
+                report.failures[ticker] = "not written: the prices writer stopped"
+    report.loaded += len(written)
+    if written:
+        conn = connect_db(db_path)
+        try:
+            refresh_analytics(conn, sorted(written))
+        finally:
+            conn.close()
+    report.seconds = time.perf_counter() - start
+    logger.info(report.summary())
+    return report
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="./database/stocks.db", help="path of the stocks database")
+    parser.add_argument("--tickers", nargs="*", default=[], help="tickers to load")
+    parser.add_argument("--file", help="text file of tickers or index constituents CSV")
+    parser.add_argument("--workers", type=int, default=8, help="batches in flight")
+    parser.add_argument("--rate", type=float, default=4, help="batch downloads started per second")
+    parser.add_argument("--batch-size", type=int, default=20, help="tickers per batch")
+    args = parser.parse_args(argv)
+
+    tickers = args.tickers + (read_tickers(args.file) if args.file else [])
+    if not tickers:
+        parser.error("pass --tickers or --file")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    report = load_universe(
+        args.db, tickers,
+        max_workers = args.workers,
+        requests_per_second = args.rate,
+        batch_size = args.batch_size,
+    )
+    print(report.summary())
+    return 1 if report.failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,517 @@
+#%%
+import os
+import re
+import json
+import math
+import numpy as np
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import fsspec
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+    DEFAULT_PERSIST_DIR,
+    DEFAULT_PERSIST_FNAME,
+)
+from llama_index.core.vector_stores.simple import (
+    SimpleVectorStore,
+    _build_metadata_filter_fn,
+    NAMESPACE_SEP,
+    DEFAULT_VECTOR_STORE,
+)
+from llama_index.core.vector_stores.utils import (
+    node_to_metadata_dict,
+    metadata_dict_to_node
+)
+
+VECTORS_SUFFIX = ".npy"
+SIDECAR_SUFFIX = ".meta.json"
+HNSW_INDEX_FNAME = "hnsw.bin"
+HNSW_NODES_FNAME = "hnsw_nodes.json"
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalizes the rows of a matrix so that cosine similarity is a dot product"""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+#%%
+class MmapVectorStore(BasePydanticVectorStore):
+    """Vector store persisted as a float32 matrix that is memory-mapped on load.
+
+    The embeddings live in a ``.npy`` file next to a JSON sidecar holding the node
+    ids, ref doc ids and metadata. Opening the store only maps the matrix, so the
+    vectors are paged in from disk the first time the store is queried instead of
+    being parsed from JSON at startup.
+    """
+
+    stores_text: bool = False
+
+    _matrix: Optional[np.ndarray] = PrivateAttr(default=None)
+    _pending: List[np.ndarray] = PrivateAttr(default_factory=list)
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[str] = PrivateAttr(default_factory=list)
+    _metadata: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _deleted: set = PrivateAttr(default_factory=set)
+    _rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **kwargs: Any) -> None:
+        """Initialize an empty store"""
+        super().__init__(**kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        return
+
+    @staticmethod
+    def _paths(persist_path: str):
+        """Returns the matrix and sidecar paths for a llama-index persist path"""
+        base = os.path.splitext(persist_path)[0]
+        return base + VECTORS_SUFFIX, base + SIDECAR_SUFFIX
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str) -> "MmapVectorStore":
+        """Maps a persisted store. Falls back to converting a legacy
+        SimpleVectorStore JSON file found at the same path."""
+        vectors_path, sidecar_path = cls._paths(persist_path)
+        store = cls()
+        if os.path.exists(vectors_path) and os.path.exists(sidecar_path):
+            with open(sidecar_path, "r") as file:
+                sidecar = json.load(file)
+            store._matrix = np.load(vectors_path, mmap_mode="r")
+            store._node_ids = sidecar["node_ids"]
+            store._ref_doc_ids = sidecar["ref_doc_ids"]
+            store._metadata = sidecar["metadata"]
+            store._rows = {node_id: i for i, node_id in enumerate(store._node_ids)}
+        elif os.path.exists(persist_path):
+            store = cls.from_simple_vector_store(
+                SimpleVectorStore.from_persist_path(persist_path)
+            )
+            store.persist(persist_path)
+        return store
+
+    @classmethod
+    def from_persist_dir(
+        cls,
+        persist_dir: str = DEFAULT_PERSIST_DIR,
+        namespace: str = DEFAULT_VECTOR_STORE,
+    ) -> "MmapVectorStore":
+        """Maps the store persisted under a storage context directory"""
+        return cls.from_persist_path(os.path.join(
+            persist_dir, f"{namespace}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+        ))
+
+    @classmethod
+    def from_simple_vector_store(cls, simple_store: SimpleVectorStore) -> "MmapVectorStore":
+        """Converts an in-memory SimpleVectorStore"""
+        store = cls()
+        data = simple_store.data
+        for node_id, embedding in data.embedding_dict.items():
+            store._append(
+                node_id = node_id,
+                embedding = embedding,
+                ref_doc_id = data.text_id_to_ref_doc_id.get(node_id, "None"),
+                metadata = (data.metadata_dict or {}).get(node_id, {}),
+            )
+        return store
+
+    def _append(self, node_id: str, embedding: List[float], ref_doc_id: str, metadata: Dict):
+        if node_id in self._rows:
+            self._deleted.add(self._rows[node_id])
+        self._rows[node_id] = len(self._node_ids)
+        self._node_ids.append(node_id)
+        self._ref_doc_ids.append(ref_doc_id)
+        self._metadata.append(metadata)
+        self._pending.append(np.asarray(embedding, dtype=np.float32))
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Add nodes to the store. New rows are held in memory until persisted."""
+        for node in nodes:
+            metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+            metadata.pop("_node_content", None)
+            self._append(
+                node_id = node.node_id,
+                embedding = node.get_embedding(),
+                ref_doc_id = node.ref_doc_id or "None",
+                metadata = metadata,
+            )
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Tombstones all rows belonging to a document. Rows are dropped from
+        disk on the next persist."""
+        for row, ref_doc_id_ in enumerate(self._ref_doc_ids):
+            if ref_doc_id_ == ref_doc_id:
+                self._deleted.add(row)
+                self._rows.pop(self._node_ids[row], None)
+
+    def clear(self) -> None:
+        """Clear the store"""
+        self._matrix = None
+        self._pending = []
+        self._node_ids, self._ref_doc_ids, self._metadata = [], [], []
+        self._deleted = set()
+        self._rows = {}
+
+    def _scores(self, query_embedding: np.ndarray) -> np.ndarray:
+        """Cosine similarity of the query against every row. The mapped matrix
+        and the in-memory rows are scored separately so the map is never copied."""
+        scores = []
+        if self._matrix is not None and len(self._matrix):
+            scores.append(self._matrix @ query_embedding)
+        if self._pending:
+            scores.append(_normalize(np.vstack(self._pending)) @ query_embedding)
+        if not scores:
+            return np.empty(0, dtype=np.float32)
+        return np.concatenate(scores)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Get the top k most similar node ids"""
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+        query_embedding = _normalize(np.asarray(query.query_embedding, dtype=np.float32))
+        scores = self._scores(query_embedding)
+
+        mask = np.ones(len(scores), dtype=bool)
+        if self._deleted:
+            mask[list(self._deleted)] = False
+        if query.node_ids is not None:
+            available_ids = set(query.node_ids)
+            mask &= np.array([node_id in available_ids for node_id in self._node_ids], dtype=bool)
+        if query.filters is not None:
+            filter_fn = _build_metadata_filter_fn(
+                lambda row: self._metadata[row], query.filters
+            )
+            mask &= np.array([filter_fn(row) for row in range(len(scores))], dtype=bool)
+
+        candidates = np.flatnonzero(mask)
+        k = min(query.similarity_top_k, len(candidates))
+        if k == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return VectorStoreQueryResult(
+            similarities = scores[top].tolist(),
+            ids = [self._node_ids[row] for row in top],
+        )
+
+    def persist(
+        self,
+        persist_path: str = os.path.join(DEFAULT_PERSIST_DIR, DEFAULT_PERSIST_FNAME),
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> None:
+        """Writes the matrix and sidecar next to ``persist_path`` and re-maps the
+        matrix. Only the local filesystem is supported."""
+        vectors_path, sidecar_path = self._paths(persist_path)
+        os.makedirs(os.path.dirname(vectors_path) or ".", exist_ok=True)
+
+        n_mapped = 0 if self._matrix is None else len(self._matrix)
+        keep = [row for row in range(len(self._node_ids)) if row not in self._deleted]
+        dim = (
+            self._matrix.shape[1] if n_mapped
+            else len(self._pending[0]) if self._pending
+            else 0
+        )
+
+        ## Copy rows in chunks so the existing map is never fully resident
+        tmp_path = vectors_path + ".tmp"
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=(len(keep), dim)
+        )
+        pending = _normalize(np.vstack(self._pending)) if self._pending else None
+        chunk = 4096
+        for start in range(0, len(keep), chunk):
+            rows = np.asarray(keep[start:start + chunk])
+            mapped, fresh = rows[rows < n_mapped], rows[rows >= n_mapped] - n_mapped
+            block = []
+            if len(mapped):
+                block.append(self._matrix[mapped])
+            if len(fresh):
+                block.append(pending[fresh])
+            out[start:start + len(rows)] = np.vstack(block)
+        out.flush()
+        del out
+        os.replace(tmp_path, vectors_path)
+
+        self._node_ids = [self._node_ids[row] for row in keep]
+        self._ref_doc_ids = [self._ref_doc_ids[row] for row in keep]
+        self._metadata = [self._metadata[row] for row in keep]
+        with open(sidecar_path, "w") as file:
+            json.dump({
+                "node_ids": self._node_ids,
+                "ref_doc_ids": self._ref_doc_ids,
+                "metadata": self._metadata,
+            }, file)
+
+        self._matrix = np.load(vectors_path, mmap_mode="r")
+        self._pending = []
+        self._deleted = set()
+        self._rows = {node_id: i for i, node_id in enumerate(self._node_ids)}
+
+#%%
+class BM25Index:
+    """Minimal in-process Okapi BM25 index used as the sparse side of hybrid search"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs: Dict[int, Counter] = {}
+        self.doc_freqs: Counter = Counter()
+        self.total_length = 0
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return re.findall(r"\w+", text.lower())
+
+    def add(self, row: int, text: str):
+        tokens = self.tokenize(text)
+        self.term_freqs[row] = Counter(tokens)
+        self.doc_freqs.update(set(tokens))
+        self.total_length += len(tokens)
+
+    def remove(self, row: int):
+        term_freqs = self.term_freqs.pop(row, None)
+        if term_freqs is None:
+            return
+        self.doc_freqs.subtract(term_freqs.keys())
+        self.total_length -= sum(term_freqs.values())
+
+    def query(self, text: str, top_k: int) -> List[Tuple[int, float]]:
+        """Returns the top k (row, score) pairs for a query string"""
+        n_docs = len(self.term_freqs)
+        if n_docs == 0:
+            return []
+        avg_length = self.total_length / n_docs
+        terms = [t for t in set(self.tokenize(text)) if self.doc_freqs[t] > 0]
+        scores = {}
+        for row, term_freqs in self.term_freqs.items():
+            length = sum(term_freqs.values())
+            score = 0.0
+            for term in terms:
+                tf = term_freqs.get(term, 0)
+                if tf == 0:
+                    continue
+                idf = math.log(1 + (n_docs - self.doc_freqs[term] + 0.5) / (self.doc_freqs[term] + 0.5))
+                score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+            if score > 0:
+                scores[row] = score
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+def _relative_score_fusion(
+    dense: List[Tuple[int, float]],
+    sparse: List[Tuple[int, float]],
+    alpha: float,
+) -> Dict[int, float]:
+    """Min-max normalizes both result lists and blends them. alpha=1 is pure
+    dense search, alpha=0 is pure BM25."""
+    def _scale(results):
+        if not results:
+            return {}
+        scores = [score for _, score in results]
+        low, high = min(scores), max(scores)
+        spread = (high - low) or 1.0
+        return {row: (score - low) / spread if high != low else 1.0 for row, score in results}
+    dense, sparse = _scale(dense), _scale(sparse)
+    return {
+        row: alpha * dense.get(row, 0.0) + (1 - alpha) * sparse.get(row, 0.0)
+        for row in set(dense) | set(sparse)
+    }
+
+class HnswVectorStore(BasePydanticVectorStore):
+    """Embedded vector store: an in-process HNSW graph for dense search with a BM25
+    side-index for hybrid search. Nodes are stored with their text so the store can
+    be reloaded from ``persist_dir`` without a docstore or a running vector database.
+    """
+
+    stores_text: bool = True
+    persist_dir: Optional[str] = None
+    ef_construction: int = 200
+    M: int = 16
+    ef_search: int = 64
+
+    _index: Any = PrivateAttr(default=None)
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _metadata: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _deleted: set = PrivateAttr(default_factory=set)
+    _rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _bm25: BM25Index = PrivateAttr(default_factory=BM25Index)
+
+    def __init__(self, **kwargs: Any) -> None:
+        """Initialize params"""
+        super().__init__(**kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HnswVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return self._index
+
+    def _alive(self) -> int:
+        return len(self._node_ids) - len(self._deleted)
+
+    def _init_index(self, dim: int, max_elements: int):
+        import hnswlib
+        self._dim = dim
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(
+            max_elements = max(max_elements, 1024),
+            ef_construction = self.ef_construction,
+            M = self.M,
+        )
+        self._index.set_ef(self.ef_search)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, **kwargs: Any) -> "HnswVectorStore":
+        """Loads a persisted store. Returns an empty store bound to ``persist_dir``
+        if nothing has been persisted there yet."""
+        import hnswlib
+        store = cls(persist_dir=persist_dir, **kwargs)
+        nodes_path = os.path.join(persist_dir, HNSW_NODES_FNAME)
+        if not os.path.exists(nodes_path):
+            return store
+        with open(nodes_path, "r") as file:
+            data = json.load(file)
+        store._dim = data["dim"]
+        store._node_ids = data["node_ids"]
+        store._metadata = data["metadata"]
+        store._deleted = set(data["deleted"])
+        store._rows = {
+            node_id: row for row, node_id in enumerate(store._node_ids)
+            if row not in store._deleted
+        }
+        store._index = hnswlib.Index(space="cosine", dim=store._dim)
+        store._index.load_index(os.path.join(persist_dir, HNSW_INDEX_FNAME))
+        store._index.set_ef(store.ef_search)
+        for row, metadata in enumerate(store._metadata):
+            if row not in store._deleted:
+                store._bm25.add(row, metadata_dict_to_node(metadata).get_content(
+                    metadata_mode=MetadataMode.NONE
+                ))
+        return store
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Add nodes to the HNSW graph and the BM25 index"""
+        if not nodes:
+            return []
+        embeddings = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        if self._index is None:
+            self._init_index(dim=embeddings.shape[1], max_elements=2 * len(nodes))
+        needed = len(self._node_ids) + len(nodes)
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(2 * needed)
+
+        rows = np.arange(len(self._node_ids), needed)
+        for row, node in zip(rows, nodes):
+            if node.node_id in self._rows:
+                self._delete_row(self._rows[node.node_id])
+            self._rows[node.node_id] = int(row)
+            self._node_ids.append(node.node_id)
+            self._metadata.append(node_to_metadata_dict(node, remove_text=False, flat_metadata=False))
+            self._bm25.add(int(row), node.get_content(metadata_mode=MetadataMode.NONE))
+        self._index.add_items(embeddings, rows)
+        return [node.node_id for node in nodes]
+
+    def _delete_row(self, row: int):
+        if row in self._deleted:
+            return
+        self._deleted.add(row)
+        self._rows.pop(self._node_ids[row], None)
+        self._index.mark_deleted(row)
+        self._bm25.remove(row)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Delete all nodes belonging to a document"""
+        for row, metadata in enumerate(self._metadata):
+            if metadata.get("ref_doc_id") == ref_doc_id or metadata.get("doc_id") == ref_doc_id:
+                self._delete_row(row)
+
+    def _dense_query(self, embedding: List[float], top_k: int, filter_fn) -> List[Tuple[int, float]]:
+        k = min(top_k, self._alive())
+        while k > 0:
+            try:
+                self._index.set_ef(max(self.ef_search, k))
+                labels, distances = self._index.knn_query(
+                    np.asarray([embedding], dtype=np.float32), k=k, filter=filter_fn
+                )
+                return [(int(row), 1.0 - float(dist)) for row, dist in zip(labels[0], distances[0])]
+            except RuntimeError:
+                ## Fewer than k nodes pass the filter
+                k //= 2
+        return []
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Dense HNSW search, fused with BM25 results in hybrid mode"""
+        if self._index is None or self._alive() == 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        if query.mode not in (VectorStoreQueryMode.DEFAULT, VectorStoreQueryMode.HYBRID):
+            raise ValueError(f"Invalid query mode: {query.mode}")
+
+        ## Like other text-storing stores, empty id lists mean "no restriction":
+        ## indices loaded with from_vector_store pass an empty node_ids list
+        allowed = None
+        if query.node_ids or query.doc_ids or query.filters is not None:
+            metadata_fn = _build_metadata_filter_fn(lambda row: self._metadata[row], query.filters)
+            node_ids = set(query.node_ids) if query.node_ids else None
+            doc_ids = set(query.doc_ids) if query.doc_ids else None
+            allowed = {
+                row for row in range(len(self._node_ids))
+                if row not in self._deleted
+                and (node_ids is None or self._node_ids[row] in node_ids)
+                and (doc_ids is None or self._metadata[row].get("ref_doc_id") in doc_ids)
+                and metadata_fn(row)
+            }
+        filter_fn = None if allowed is None else (lambda row: row in allowed)
+
+        dense = self._dense_query(query.query_embedding, query.similarity_top_k, filter_fn)
+        if query.mode == VectorStoreQueryMode.HYBRID and query.query_str:
+            sparse = self._bm25.query(query.query_str, len(self._node_ids))
+            if allowed is not None:
+                sparse = [(row, score) for row, score in sparse if row in allowed]
+            sparse = sparse[:query.sparse_top_k or query.similarity_top_k]
+            fused = _relative_score_fusion(
+                dense, sparse, alpha=0.5 if query.alpha is None else query.alpha
+            )
+            top_k = query.hybrid_top_k or query.similarity_top_k
+            results = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        else:
+            results = dense
+
+        return VectorStoreQueryResult(
+            nodes = [metadata_dict_to_node(self._metadata[row]) for row, _ in results],
+            similarities = [score for _, score in results],
+            ids = [self._node_ids[row] for row, _ in results],
+        )
+
+    def persist(
+        self,
+        persist_path: Optional[str] = None,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> None:
+        """Saves the HNSW graph and node sidecar into ``persist_dir``. A llama-index
+        persist path is accepted for compatibility and its directory is used."""
+        persist_dir = os.path.dirname(persist_path) if persist_path else self.persist_dir
+        if persist_dir is None:
+            raise ValueError("persist_dir must be set to persist the HNSW store")
+        if self._index is None:
+            return
+        os.makedirs(persist_dir, exist_ok=True)
+        self._index.save_index(os.path.join(persist_dir, HNSW_INDEX_FNAME))
+        with open(os.path.join(persist_dir, HNSW_NODES_FNAME), "w") as file:
+            json.dump({
+                "dim": self._dim,
+                "node_ids": self._node_ids,
+                "metadata": self._metadata,
+                "deleted": sorted(self._deleted),
+            }, file)
@@ -1,11 +1,22 @@
 #%%
 import os
+import re
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, Generator, List, Optional, Tuple
+import pandas as pd
 from dotenv import load_dotenv, find_dotenv
 from vanna.openai.openai_chat import OpenAI_Chat
 from openai import AzureOpenAI
 from vanna.chromadb.chromadb_vector import ChromaDB_VectorStore
 import yfinance as yf
-from db_utils import connect_sql
+from db_utils import PRICES_DDL, connect_db, get_tickers, migrate_ticker_tables
+from analytics_tables import ANALYTICS_DDL, refresh_analytics
+from cache_utils import SemanticCache, TTLCache, register_cache
+from tracing import set_span_attributes
 
 # __curdir__ = os.getcwd()
 # if ("src" in __curdir__) or ("notebooks" in __curdir__):
@@ -15,6 +26,15 @@ from db_utils import connect_sql
 
 db_path = "../llm/database/stocks.db"
 
+## Training manifest and company name cache, kept next to the database
+MANIFEST_PATH = os.path.join(os.path.dirname(db_path), "vanna_manifest.json")
+LONG_NAMES_PATH = os.path.join(os.path.dirname(db_path), "long_names.json")
+
+## Results larger than this are truncated, see MyVanna.stream_sql
+MAX_RESULT_ROWS = int(os.getenv("VANNA_MAX_ROWS", 10_000))
+
+logger = logging.getLogger(__name__)
+
 _ = load_dotenv(find_dotenv())
 
 client = AzureOpenAI(
@@ -24,34 +44,339 @@ client = AzureOpenAI(
     api_key=os.environ["AZURE_OPENAI_API_KEY"],
 )
 
+def _clean_sql(sql: str) -> str:
+    """Drops trailing semicolons and comments, which would break the query
+    when it is wrapped, e.g. in ``SELECT * FROM (...) LIMIT ?``"""
+    end, i = 0, 0
+    while i < len(sql):
+        if sql[i] in "'\"`[":
+            close = sql.find("]" if sql[i] == "[" else sql[i], i + 1)
+            i = end = len(sql) if close < 0 else close + 1
+        elif sql.startswith("--", i):
+            newline = sql.find("\n", i)
+            i = len(sql) if newline < 0 else newline + 1
+        elif sql.startswith("/*", i):
+            close = sql.find("*/", i + 2)
+            i = len(sql) if close < 0 else close + 2
+        else:
+            if not (sql[i].isspace() or sql[i] == ";"):
+                end = i + 1
+            i += 1
+    return sql[:end].strip()
+
+def _read_only(path: str) -> sqlite3.Connection:
+    return sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True, check_same_thread=False)
+
+def explain_sql(sql: str, path: str = db_path) -> bool:
+    """Whether SQLite can plan a query against the current schema, without running it"""
+    try:
+        conn = _read_only(path)
+        try:
+            conn.execute(f"EXPLAIN {_clean_sql(sql)}")
+        finally:
+            conn.close()
+        return True
+    except (sqlite3.Error, sqlite3.Warning):
+        return False
+
+def database_version(path: str = db_path) -> Tuple:
+    """Changes whenever the database (or its write-ahead log) is written to"""
+    version = []
+    for file_path in (path, path + "-wal"):
+        try:
+            stat = os.stat(file_path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+def collect_stream(chunks: Generator[pd.DataFrame, None, pd.DataFrame]) -> pd.DataFrame:
+    """Reads the rest of a ``stream_sql`` generator and returns the complete result"""
+    while True:
+        try:
+            next(chunks)
+        except StopIteration as stop:
+            # Callers such as the generated plotly code may modify the frame
+            return stop.value.copy()
+
 class MyVanna(ChromaDB_VectorStore, OpenAI_Chat):
     def __init__(self, config=None):
         ChromaDB_VectorStore.__init__(self, config=config)
         OpenAI_Chat.__init__(self,
                              client = client,
                              config = config)
+        # Questions are embedded with the vector store's local embedding
+        # function, so a cache lookup costs no API call
+        self.sql_cache = register_cache("vanna_sql", SemanticCache(
+            embed_fn = self.generate_embedding,
+            similarity_threshold = 0.95,
+            max_size = 512,
+            ttl = 7 * 24 * 3600,
+            signature_fn = self._question_signature,
+        ))
+        self.schema_version: Optional[str] = None
+        self._cached_schema_version: Optional[str] = None
+        self._schema_names: set = set()
+        self.results_cache = register_cache("vanna_results", TTLCache(max_size=64, ttl=3600))
+        self.max_rows = MAX_RESULT_ROWS
+        self.db_path: Optional[str] = None
+
+    def connect_to_sqlite(self, url: str, **kwargs):
+        """Connects Vanna to the database, with queries run through ``run_sql``'s
+        result cache and row cap instead of Vanna's plain pandas runner"""
+        super().connect_to_sqlite(url, **kwargs)
+        self.db_path = url
+        self.run_sql = self._run_sql
+        self.run_sql_is_set = True
+
+    def stream_sql(self, sql: str, chunk_size: int = 500) -> Generator[pd.DataFrame, None, pd.DataFrame]:
+        """Yields the result of a query in chunks of rows as they are read, so
+        the first rows can be shown before the rest has been loaded. At most
+        ``max_rows`` rows are read; the limit is applied by SQLite. Complete
+        results are cached per database version, and ``run_sql`` returns them
+        with ``attrs["truncated"]`` set if rows were cut off. The complete
+        result is the generator's return value, see ``collect_stream``."""
+        return (yield from self._stream_sql(sql, chunk_size))
+
+    def _stream_sql(self, sql: str, chunk_size: int) -> Generator[pd.DataFrame, None, pd.DataFrame]:
+        sql = _clean_sql(sql)
+        key = (sql, database_version(self.db_path))
+        cached = self.results_cache.get(key)
+        if cached is not None:
+            set_span_attributes(results_cache="hit")
+            for start in range(0, max(len(cached), 1), chunk_size):
+                yield cached.iloc[start:start + chunk_size]
+            return cached
+        set_span_attributes(results_cache="miss")
+        chunks = []
+        conn = _read_only(self.db_path)
+        try:
+            # One row past the cap tells whether the result was truncated
+            cursor = conn.execute(f"SELECT * FROM ({sql}) LIMIT ?", (self.max_rows + 1,))
+            columns = [column[0] for column in cursor.description]
+            rows_left, truncated = self.max_rows, False
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) > rows_left:
+                    rows, truncated = rows[:rows_left], True
+                rows_left -= len(rows)
+                if rows or not chunks:
+                    chunk = pd.DataFrame.from_records(rows, columns=columns)
+                    chunks.append(chunk)
+                    yield chunk
+                if not rows or truncated:
+                    break
+        finally:
+            conn.close()
+        df = pd.concat(chunks, ignore_index=True)
+        df.attrs["truncated"] = truncated
+        if truncated:
+            logger.info("Query result truncated to %d rows: %s", self.max_rows, sql)
+        set_span_attributes(rows=len(df), truncated=truncated)
+        self.results_cache.set(key, df)
+        return df
+
+    def _run_sql(self, sql: str) -> pd.DataFrame:
+        return collect_stream(self._stream_sql(sql, chunk_size=5000))
+
+    def set_schema(self, manifest: Dict[str, Dict]):
+        """Records the trained schema. Cached SQL written for another schema is dropped."""
+        self.schema_version = schema_fingerprint(manifest)
+        self._schema_names = {name.lower() for name in manifest}
+
+    def _question_signature(self, question: str) -> Tuple[str, ...]:
+        """Tickers, tables and numbers mentioned in a question. Near-duplicate
+        questions only share SQL if these match, e.g. not 'AAPL in 2023' and
+        'MSFT in 2023'."""
+        words = re.findall(r"\w+(?:\.\w+)*", question.lower())
+        return tuple(sorted(
+            {word for word in words if word in self._schema_names or word[0].isdigit()}
+        ))
+
+    def _plans(self, sql: str) -> bool:
+        """Whether the connected database can plan the query"""
+        return self.db_path is not None and explain_sql(sql, self.db_path)
 
-def get_long_name(ticker: str):
-    return yf.Ticker(ticker).info['longName']
+    def generate_sql(self, question: str, **kwargs) -> str:
+        """Serves SQL for previously asked (or nearly identical) questions from a
+        cache, after checking with EXPLAIN that it still fits the schema"""
+        if self._cached_schema_version != self.schema_version:
+            self.sql_cache.clear()
+            self._cached_schema_version = self.schema_version
+        sql, embedding = self.sql_cache.lookup(question)
+        if sql is not None and self._plans(sql):
+            set_span_attributes(sql_cache="exact" if embedding is None else "semantic")
+            return sql
+        set_span_attributes(sql_cache="miss")
+        sql = super().generate_sql(question, **kwargs)
+        if sql and self._plans(sql):
+            self.sql_cache.store(question, sql, embedding=embedding)
+        return sql
+
+def _read_json(path: str) -> Dict:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _write_json(path: str, data: Dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+_long_names = _read_json(LONG_NAMES_PATH)
+_long_names_lock = threading.Lock()
+
+def get_long_name(ticker: str) -> str:
+    """Company name of a ticker. Names are cached on disk since they don't change,
+    and the ticker itself is used if Yahoo Finance can't be reached."""
+    ticker = ticker.upper()
+    with _long_names_lock:
+        if ticker in _long_names:
+            return _long_names[ticker]
+    try:
+        long_name = yf.Ticker(ticker).info['longName']
+    except Exception:
+        logger.warning("Could not look up the company name of %s", ticker)
+        return ticker
+    with _long_names_lock:
+        _long_names[ticker] = long_name
+        _write_json(LONG_NAMES_PATH, _long_names)
+    return long_name
+
+def get_prices_training() -> Dict[str, str]:
+    """The DDL and documentation Vanna is trained on for the prices table"""
+    return {
+        "ddl": PRICES_DDL,
+        "documentation": (
+            "The prices table holds the daily prices of every stock, one row per "
+            "ticker and date. Filter on the ticker column to select a stock, e.g. "
+            "WHERE ticker = 'AAPL'. Dates are 'YYYY-MM-DD' text."
+        ),
+    }
+
+## What each analytics table holds, so generated SQL reads them instead of
+## computing returns and moving averages over the prices table
+ANALYTICS_DOCUMENTATION = {
+    "daily_metrics": (
+        "The daily_metrics table holds precomputed daily metrics of every stock, one row "
+        "per ticker and date: daily_return (simple return of adj_close from the previous "
+        "trading day), log_return, and the 20, 50 and 200-day moving averages of adj_close "
+        "(ma_20, ma_50, ma_200, NULL until there is enough history). Returns are fractions, "
+        "e.g. 0.05 is 5%. Use it instead of window functions over the prices table for "
+        "returns, volatility and moving averages."
+    ),
+    "monthly_prices": (
+        "The monthly_prices table holds monthly OHLC prices of every stock, one row per "
+        "ticker and month ('YYYY-MM' text): the open of the first trading day, the high, the "
+        "low, the close and adj_close of the last trading day, the total volume, the number of "
+        "trading_days and monthly_return (fraction, from the previous month's adj_close). "
+        "Use it for monthly performance instead of aggregating the prices table."
+    ),
+    "yearly_prices": (
+        "The yearly_prices table holds yearly OHLC prices of every stock, one row per ticker "
+        "and year ('YYYY' text, e.g. year = '2023'): the open of the first trading day, the "
+        "high, the low, the close and adj_close of the last trading day, the total volume, "
+        "the number of trading_days and yearly_return (fraction, from the previous year's "
+        "adj_close). Use it for annual returns and yearly highs and lows."
+    ),
+}
+
+def get_analytics_training() -> Dict[str, Dict[str, str]]:
+    """The DDL and documentation Vanna is trained on for the analytics tables"""
+    return {
+        table: {"ddl": ddl, "documentation": ANALYTICS_DOCUMENTATION[table]}
+        for table, ddl in ANALYTICS_DDL.items()
+    }
+
+def get_ticker_training(ticker: str) -> Dict[str, str]:
+    """The documentation Vanna is trained on for a ticker in the prices table"""
+    return {
+        "documentation": f"{get_long_name(ticker)}'s stock ticker is {ticker}.",
+    }
+
+def fingerprint(training: Dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps(training, sort_keys=True).encode()).hexdigest()
+
+def schema_fingerprint(manifest: Dict[str, Dict]) -> str:
+    """One hash over every manifest entry, which changes whenever the schema Vanna knows changes"""
+    return hashlib.sha256(json.dumps(
+        {table: entry["fingerprint"] for table, entry in manifest.items()}, sort_keys=True
+    ).encode()).hexdigest()
+
+def sync_training(
+    vn: ChromaDB_VectorStore,
+    trainings: Dict[str, Dict[str, str]],
+    manifest_path: str = MANIFEST_PATH,
+) -> Dict[str, Dict]:
+    """Trains Vanna on the tables whose DDL or documentation is new or changed,
+    and removes the training data of tables that are gone or changed. What was
+    trained is recorded in a manifest of fingerprints and training data ids, so
+    an unchanged schema costs no embeddings at all. DDL and documentation in the
+    vector store that the manifest doesn't list, e.g. the per-ticker tables
+    trained before there was a manifest, are removed; question/SQL pairs are kept.
+
+    Args:
+        vn: the Vanna instance
+        trainings: DDL and/or documentation per table or ticker
+        manifest_path: where the manifest is kept
+    """
+    manifest = _read_json(manifest_path)
+    # The vector store may have been wiped or trained independently of the manifest
+    training_data = vn.get_training_data()
+    stored_ids = set(training_data["id"]) if training_data is not None and "id" in training_data else set()
+    changed: List[str] = []
+    for table in list(manifest):
+        entry = manifest[table]
+        if (table not in trainings
+                or entry["fingerprint"] != fingerprint(trainings[table])
+                or not set(entry["ids"]) <= stored_ids):
+            for training_id in entry["ids"]:
+                if training_id in stored_ids:
+                    vn.remove_training_data(id=training_id)
+            del manifest[table]
+    for table, training in trainings.items():
+        if table in manifest:
+            continue
+        manifest[table] = {
+            "fingerprint": fingerprint(training),
+            "ids": [vn.train(**{kind: text}) for kind, text in training.items()],
+        }
+        changed.append(table)
+    if training_data is not None and "training_data_type" in training_data:
+        known_ids = {training_id for entry in manifest.values() for training_id in entry["ids"]}
+        stale = training_data[
+            training_data["training_data_type"].isin(["ddl", "documentation"])
+            & ~training_data["id"].isin(known_ids)
+        ]
+        for training_id in stale["id"]:
+            vn.remove_training_data(id=training_id)
+        if len(stale):
+            logger.info("Vanna training: removed %d entries not in the manifest", len(stale))
+    _write_json(manifest_path, manifest)
+    logger.info("Vanna training: %d tables up to date, %d retrained", len(trainings) - len(changed), len(changed))
+    return manifest
 
 ## Instantiate and initialize
 vn = MyVanna(config={"model":"gpt4-o"})
 vn.connect_to_sqlite(db_path)
 
-_, tables = connect_sql(db_path)
-
-for ticker in tables:
-    vn.train(ddl=f"""
-        CREATE TABLE IF NOT EXISTS {ticker.lower()} (
-            id INT PRIMARY KEY,
-            date DATETIME,
-            open FLOAT,
-            high FLOAT,
-            low FLOAT,
-            close FLOAT,
-            volume INT,
-        )
-    """)
-    vn.train(
-        documentation = f"{get_long_name(ticker)}'s stock ticker is {ticker}."
-    )
\ No newline at end of file
+## Databases created with one table per ticker are copied to the prices table.
+## The old tables are only dropped by `python src/db_utils.py --drop-ticker-tables`.
+migrate_ticker_tables(db_path)
+
+## Materializes the analytics tables of databases loaded before they existed
+_conn = connect_db(db_path)
+try:
+    refresh_analytics(_conn)
+finally:
+    _conn.close()
+
+training_manifest = sync_training(vn, {
+    "prices": get_prices_training(),
+    **get_analytics_training(),
+    **{ticker: get_ticker_training(ticker) for ticker in get_tickers(db_path)},
+})
+vn.set_schema(training_manifest)
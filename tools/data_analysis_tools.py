@@ -21,6 +21,8 @@ if ("tools" in __curdir__) or \
 else:
     sys.path.append("./src")
 from utils import rename_columns, process_string
+from src.tool_outputs import compact_tool
+from src.tool_cache import memoize_tool
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -353,4 +355,4 @@ class DataAnalysisTools(BaseToolSpec):
 
 def get_da_tools():
     da = DataAnalysisTools()
-    return da.to_tool_list()  
+    return [compact_tool(memoize_tool(tool)) for tool in da.to_tool_list()]  
@@ -15,6 +15,19 @@ from collections import defaultdict
 import warnings
 warnings.filterwarnings("ignore")
 
+import os
+import sys
+__curdir__ = os.getcwd()
+
+if "tools" in __curdir__:
+    sys.path.append(os.path.join(
+        __curdir__,
+        "../src"
+    ))
+else:
+    sys.path.append("./src")
+from tracing import span
+
 models = [
     ARCH(1), 
     ARCH(2), 
@@ -52,13 +65,14 @@ class Forecaster:
         """
         self.tickers = [ticker.upper() for ticker in tickers]
         try:
-            self.df = yf.download(
-                tickers, 
-                start = (
-                    datetime.now() - relativedelta(years=10)
-                ).strftime("%Y-%m-%d"), 
-                end = datetime.today().strftime("%Y-%m-%d"), 
-                interval='1mo') # use monthly prices
+            with span("forecaster.download", tickers=",".join(self.tickers)):
+                self.df = yf.download(
+                    tickers, 
+                    start = (
+                        datetime.now() - relativedelta(years=10)
+                    ).strftime("%Y-%m-%d"), 
+                    end = datetime.today().strftime("%Y-%m-%d"), 
+                    interval='1mo') # use monthly prices
         except Exception as e:
             raise ValueError(e)
         if len(self.tickers)>1:
@@ -94,12 +108,13 @@ class Forecaster:
             n_jobs = -1)
         
         ## Prepare cross-validation dataframe
-        self.crossvalidation_df = self.sf.cross_validation(
-            df = self.returns,
-            h = h,
-            step_size = 3,
-            n_windows = 4
-        )
+        with span("forecaster.cross_validation", models=len(models)):
+            self.crossvalidation_df = self.sf.cross_validation(
+                df = self.returns,
+                h = h,
+                step_size = 3,
+                n_windows = 4
+            )
         self.crossvalidation_df = self.crossvalidation_df.reset_index()
         self.crossvalidation_df.rename(columns = {'y' : 'actual'}, inplace = True)
     
@@ -233,7 +248,12 @@ class Forecaster:
         Returns:
             Dictionary of forecasts
         """
-        self.post__init__(tickers = tickers, h=h)
-        self.evaluate()
-        self.forecast(h=h, levels=levels)
-        return self.forecast_ticker(ticker=ticker)
\ No newline at end of file
+        with span("forecaster.prepare", tickers=",".join(tickers), h=h) as stage:
+            self.post__init__(tickers = tickers, h=h)
+            stage.set_attribute("rows", len(self.returns))
+        with span("forecaster.evaluate"):
+            self.evaluate()
+        with span("forecaster.forecast", h=h):
+            self.forecast(h=h, levels=levels)
+        with span("forecaster.forecast_ticker", ticker=ticker or ""):
+            return self.forecast_ticker(ticker=ticker)
\ No newline at end of file
@@ -2,6 +2,9 @@ from llama_index.core.tools import FunctionTool
 import yfinance as yf
 import pandas as pd
 
+from src.tool_outputs import compact_tool
+from src.tool_cache import memoize_tool
+
 class FundamentalAnalyst:
     def __init__(self, ticker: str):
         """Initialize the fundamental analyst tool"""
@@ -121,4 +124,6 @@ def evaluate_fundamentals(ticker: str):
     return df
 
 def get_fa_tools():
-    return FunctionTool.from_defaults(evaluate_fundamentals)
+    return [
+        compact_tool(memoize_tool(FunctionTool.from_defaults(evaluate_fundamentals))),
+    ]
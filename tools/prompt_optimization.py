@@ -35,7 +35,8 @@ else:
     storage_dir = "VectorIndex"
     
 from utils import CustomWebPageReader
-from llamaindex_config import llm, embed_model
+from vector_stores import MmapVectorStore
+from llamaindex_config import llm, embed_model, links
 
 ### Define variables needed ###
 _ = load_dotenv(find_dotenv())
@@ -46,13 +47,6 @@ lm = dspy.AWSAnthropic(bedrock,
 dspy.settings.configure(lm=lm)
 llm = llm
 embed_model = embed_model
-links = [
-    "https://www.investopedia.com/terms/s/stockmarket.asp",
-    "https://www.investopedia.com/ask/answers/difference-between-options-and-futures/",
-    "https://www.investopedia.com/financial-edge/0411/5-essential-things-you-need-to-know-about-every-stock-you-buy.aspx",
-    "https://www.investopedia.com/articles/fundamental/04/063004.asp",
-    "https://www.investopedia.com/terms/t/technicalanalysis.asp"  
-]
 evaluator = SemanticSimilarityEvaluator(similarity_threshold=0.5, embed_model=embed_model)
 
 ### Define utility functions ###
@@ -67,19 +61,25 @@ def load_index(persist_dir=storage_dir,
                links=links,
                embed_model=embed_model):
     """Helper function to create an index from data, persist an index 
-    and load an index from storage"""
+    and load an index from storage. Embeddings are kept in a memory-mapped
+    float32 file rather than the default JSON vector store."""
     if os.path.exists(persist_dir):
         storage_context = StorageContext.from_defaults(
-            persist_dir = storage_dir 
+            persist_dir = persist_dir,
+            vector_store = MmapVectorStore.from_persist_dir(persist_dir)
         )
         return load_index_from_storage(storage_context,**{"embed_model":embed_model})
     
     docs = CustomWebPageReader(
         html_to_text=True
     ).load_data(urls=links)
+    storage_context = StorageContext.from_defaults(
+        vector_store = MmapVectorStore()
+    )
     index = VectorStoreIndex.from_documents(docs,
+                                            storage_context=storage_context,
                                             embed_model=embed_model)
-    index.storage_context.persist(persist_dir=storage_dir)
+    index.storage_context.persist(persist_dir=persist_dir)
     return index
 
 ### Prompt Optimization Metric ###
@@ -1,5 +1,6 @@
 import os
-from prompt_optimization import load_index
+import re
+from typing import Tuple
 
 import sys
 __curdir__ = os.getcwd()
@@ -10,41 +11,161 @@ if "tools" in __curdir__ or "notebooks" in __curdir__:
     ))
 else:
     sys.path.append("./src")
-from llamaindex_config import llm, embed_model
+from llamaindex_config import llm, embed_model, text_splitter, links
+from utils import CustomWebPageReader
+from vector_stores import HnswVectorStore
+from cache_utils import SemanticCache, register_cache
 
-import qdrant_client
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.core import VectorStoreIndex
+from llama_index.core import VectorStoreIndex, StorageContext
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.schema import QueryBundle
 from llama_index.core.tools import (
     QueryEngineTool,
     ToolMetadata
 )
 
-client = qdrant_client.QdrantClient("http://localhost:6333")
-aclient = qdrant_client.AsyncQdrantClient("http://localhost:6333")
-vector_store = QdrantVectorStore(
-    collection_name="investopedia",
-    client=client,
-    aclient=aclient,
-    fastembed_sparse_model="Qdrant/bm42-all-minilm-l6-v2-attentions",
+## Vector store backend: "qdrant", "embedded" or "auto" (qdrant if reachable,
+## otherwise the embedded HNSW + BM25 index persisted to disk)
+backend = os.getenv("RAG_VECTOR_BACKEND", "auto")
+qdrant_url = os.getenv("QDRANT_URL", "http://localhost:6333")
+if "tools" in __curdir__ or "notebooks" in __curdir__:
+    embedded_dir = os.getenv("RAG_EMBEDDED_DIR", "../EmbeddedIndex/")
+else:
+    embedded_dir = os.getenv("RAG_EMBEDDED_DIR", "EmbeddedIndex")
+
+def get_qdrant_vector_store(url: str = qdrant_url):
+    """Returns the investopedia collection hosted on a Qdrant server"""
+    import qdrant_client
+    from llama_index.vector_stores.qdrant import QdrantVectorStore
+    
+    client = qdrant_client.QdrantClient(url)
+    aclient = qdrant_client.AsyncQdrantClient(url)
+    client.get_collections() # fail fast if the server is down
+    return QdrantVectorStore(
+        collection_name="investopedia",
+        client=client,
+        aclient=aclient,
+        fastembed_sparse_model="Qdrant/bm42-all-minilm-l6-v2-attentions",
+    )
+
+def get_embedded_vector_store(persist_dir: str = embedded_dir,
+                              links = links,
+                              embed_model = embed_model):
+    """Returns the in-process HNSW + BM25 store, building and persisting it from
+    the investopedia articles on first use"""
+    vector_store = HnswVectorStore.from_persist_dir(persist_dir)
+    if vector_store.client is None:
+        docs = CustomWebPageReader(
+            html_to_text=True
+        ).load_data(urls=links)
+        VectorStoreIndex.from_documents(
+            docs,
+            storage_context = StorageContext.from_defaults(vector_store=vector_store),
+            embed_model = embed_model,
+            transformations = [text_splitter],
+        )
+        vector_store.persist()
+    return vector_store
+
+def get_vector_store(backend: str = backend):
+    """Returns the vector store for the configured backend"""
+    if backend == "embedded":
+        return get_embedded_vector_store()
+    if backend == "qdrant":
+        return get_qdrant_vector_store()
+    try:
+        return get_qdrant_vector_store()
+    except Exception:
+        return get_embedded_vector_store()
+
+## Ratios, acronyms, numbers and the topics the articles cover. A near-duplicate
+## question only shares a cached answer if it mentions the same ones.
+_KEY_TERMS = re.compile(
+    r"\b[a-z](?:/[a-z])+\b|\b\d+(?:\.\d+)?\b|\b(?:"
+    r"rsi|macd|eps|roe|roa|etfs?|ipos?|options?|futures?|calls?|puts?|ichimoku|aroon|bollinger|"
+    r"stoch(?:astic|rsi)?|accumulation|distribution|earnings|book|sales|quick|current|dividends?"
+    r")\b"
 )
 
-def get_rag_tools(qdrant_vector_store = vector_store,
+def question_key_terms(question: str) -> Tuple[str, ...]:
+    """Key terms of a question, e.g. ('p/e',) for 'What is a good P/E?'"""
+    terms = {re.sub(r"(?<=[a-z]{3})s$", "", term) for term in _KEY_TERMS.findall(question.lower())}
+    return tuple(sorted(terms))
+
+class CachedQueryEngine(BaseQueryEngine):
+    """Serves repeated questions from a semantic answer cache before falling
+    through to the wrapped query engine. On a miss the query embedding computed
+    for the cache lookup, which is of the question as asked, is handed to the
+    retriever, so it is not computed twice."""
+    
+    def __init__(self, query_engine: BaseQueryEngine, cache: SemanticCache):
+        super().__init__(callback_manager=query_engine.callback_manager)
+        self._query_engine = query_engine
+        self.cache = cache
+    
+    def _get_prompt_modules(self):
+        return {"query_engine": self._query_engine}
+    
+    def _query(self, query_bundle: QueryBundle):
+        response, embedding = self.cache.lookup(query_bundle.query_str)
+        if response is not None:
+            return response
+        response = self._query_engine.query(
+            QueryBundle(query_str=query_bundle.query_str, embedding=embedding)
+        )
+        self.cache.store(query_bundle.query_str, response, embedding=embedding)
+        return response
+    
+    async def _aquery(self, query_bundle: QueryBundle):
+        response, embedding = self.cache.lookup(query_bundle.query_str)
+        if response is not None:
+            return response
+        response = await self._query_engine.aquery(
+            QueryBundle(query_str=query_bundle.query_str, embedding=embedding)
+        )
+        self.cache.store(query_bundle.query_str, response, embedding=embedding)
+        return response
+
+def get_rag_tools(qdrant_vector_store = None,
                   llm = llm,
                   embed_model = embed_model,
                   similarity_top_k: int = 4,
-                  sparse_top_k: int = 10):
-    def load_index(qdrant_vector_store: QdrantVectorStore,
+                  sparse_top_k: int = 10,
+                  cache_similarity_threshold: float = 0.95,
+                  cache_size: int = 256,
+                  cache_ttl: float = 24 * 3600):
+    """Returns the investopedia query engine tool. The vector store defaults to
+    the backend selected by RAG_VECTOR_BACKEND. Answers are cached by normalized
+    question and by embedding similarity between questions with the same key
+    terms; set cache_size to 0 to disable."""
+    def load_index(qdrant_vector_store,
                 embed_model):
         return VectorStoreIndex.from_vector_store(
             qdrant_vector_store,
             embed_model
         ) 
+    if qdrant_vector_store is None:
+        qdrant_vector_store = get_vector_store()
+    query_kwargs = {}
+    if isinstance(qdrant_vector_store, HnswVectorStore):
+        query_kwargs["vector_store_query_mode"] = "hybrid"
     index = load_index(qdrant_vector_store, embed_model)
     query_engine = index.as_query_engine(
         llm = llm,
         similarity_top_k=similarity_top_k, 
-        sparse_top_k=sparse_top_k)
+        sparse_top_k=sparse_top_k,
+        **query_kwargs)
+    if cache_size > 0:
+        query_engine = CachedQueryEngine(
+            query_engine = query_engine,
+            cache = register_cache("investopedia_tool", SemanticCache(
+                embed_fn = embed_model.get_query_embedding,
+                similarity_threshold = cache_similarity_threshold,
+                max_size = cache_size,
+                ttl = cache_ttl,
+                signature_fn = question_key_terms,
+            ))
+        )
     query_engine_tool = [
         QueryEngineTool(
             query_engine=query_engine,
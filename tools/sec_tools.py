@@ -30,6 +30,7 @@ else:
     sys.path.append("./src")
 
 from llamaindex_config import llm, embed_model, text_splitter
+from tracing import approx_tokens, span
 
 llm = llm
 embed_model = embed_model
@@ -97,30 +98,47 @@ class SECTool(BaseToolSpec):
     
     def get_retriever_from_url(self, url: str, embed_model=embed_model):   
         """Creates an in-memory retriever from a URL"""
-        text = self._download_form_html(url=url)
-        soup = BeautifulSoup(text, 'html.parser')
-        texts = soup.get_text()
-        nodes = text_splitter.get_nodes_from_documents([Document(text=texts)])
-        return VectorStoreIndex(nodes, embed_model=embed_model).as_retriever(
+        with span("sec.download", url=url) as stage:
+            text = self._download_form_html(url=url)
+            stage.set_attribute("html_chars", len(text))
+        with span("sec.parse") as stage:
+            soup = BeautifulSoup(text, 'html.parser')
+            texts = soup.get_text()
+            nodes = text_splitter.get_nodes_from_documents([Document(text=texts)])
+            stage.set_attributes(text_tokens=approx_tokens(texts), nodes=len(nodes))
+        with span("sec.embed", nodes=len(nodes)):
+            index = VectorStoreIndex(nodes, embed_model=embed_model)
+        return index.as_retriever(
             similarity_top_k = 10
         )
     
     def return_contexts(self, url: str, question: str):
         """Retrieves and reranks nodes given a query string and a url 
         from an in-memory vector index"""
-        retriever = self.get_retriever_from_url(url = url)
-        nodes = retriever.retrieve(question)
-        reranked_nodes = self.reranker.postprocess_nodes(
-            nodes = nodes,
-            query_str = question)
-        refined_nodes = self.prompt_compressor.postprocess_nodes(
-            nodes = reranked_nodes,
-            query_str = question
-        )
-        contexts = "\n\n".join([n.get_content() for n in refined_nodes])
-        if self.device == 'cuda':
-            torch.cuda.empty_cache()
-        return contexts
+        with span("sec.return_contexts") as parent:
+            retriever = self.get_retriever_from_url(url = url)
+            with span("sec.retrieve") as stage:
+                nodes = retriever.retrieve(question)
+                stage.set_attribute("nodes", len(nodes))
+            with span("sec.rerank", nodes=len(nodes)) as stage:
+                reranked_nodes = self.reranker.postprocess_nodes(
+                    nodes = nodes,
+                    query_str = question)
+                stage.set_attribute("input_tokens", sum(approx_tokens(n.get_content()) for n in nodes))
+            with span("sec.compress", nodes=len(reranked_nodes)) as stage:
+                refined_nodes = self.prompt_compressor.postprocess_nodes(
+                    nodes = reranked_nodes,
+                    query_str = question
+                )
+                stage.set_attributes(
+                    input_tokens = sum(approx_tokens(n.get_content()) for n in reranked_nodes),
+                    output_tokens = sum(approx_tokens(n.get_content()) for n in refined_nodes),
+                )
+            contexts = "\n\n".join([n.get_content() for n in refined_nodes])
+            parent.set_attribute("output_tokens", approx_tokens(contexts))
+            if self.device == 'cuda':
+                torch.cuda.empty_cache()
+            return contexts
     
     def search_10q_10k(
         self, 
@@ -157,7 +175,8 @@ class SECTool(BaseToolSpec):
             "size": "1",
             "sort": [{ "filedAt": { "order": "desc" }}]
             }
-        filings = self.queryApi.get_filings(query)['filings']
+        with span("sec.query_filings", ticker=ticker, tenq=tenq):
+            filings = self.queryApi.get_filings(query)['filings']
         if len(filings) == 0:
             return "Sorry I couldn't find any filing for this stock, check if ticker is correct"
         link = filings[0]['linkToFilingDetails']
@@ -0,0 +1,46 @@
+#%%
+import os
+import sys
+from typing import List
+
+from llama_index.core.tools import FunctionTool
+
+__curdir__ = os.getcwd()
+if "tools" in __curdir__:
+    sys.path.append(os.path.join(__curdir__, "../src"))
+else:
+    sys.path.append("./src")
+
+from db_utils import get_ticker
+from symbol_index import symbol_index
+
+def _describe(record) -> str:
+    return f"{record.ticker} ({record.name}, {record.exchange or 'unknown exchange'})"
+
+def lookup_ticker(company_name: str) -> str:
+    """Finds the stock ticker of a company, e.g. 'Alphabet' -> GOOGL. Use this
+    before any tool that needs a ticker when the user only names the company.
+    Returns the ticker and, when the name is not known exactly, similar
+    companies to double check against."""
+    record = symbol_index.resolve(company_name)
+    if record is not None:
+        return f"{company_name}: {_describe(record)}"
+    suggestions = [r for r, _ in symbol_index.search(company_name)]
+    try:
+        ticker = get_ticker(company_name)
+    except Exception:
+        if not suggestions:
+            return f"No ticker found for '{company_name}'"
+        return f"No ticker found for '{company_name}'. Similar companies:\n" + "\n".join(
+            _describe(r) for r in suggestions
+        )
+    record = symbol_index.records.get(ticker.upper())
+    answer = f"{company_name}: {_describe(record) if record else ticker}"
+    others = [r for r in suggestions if r.ticker != ticker]
+    if others:
+        answer += "\nSimilar companies: " + "; ".join(_describe(r) for r in others)
+    return answer
+
+def get_symbol_tools() -> List[FunctionTool]:
+    """Returns the ticker lookup tool"""
+    return [FunctionTool.from_defaults(fn=lookup_ticker)]
@@ -13,6 +13,9 @@ from ta.volume import AccDistIndexIndicator
 from ta.trend import MACD, AroonIndicator, IchimokuIndicator
 from ta.momentum import StochRSIIndicator, StochasticOscillator
 
+from src.tool_outputs import compact_tool
+from src.tool_cache import memoize_tool
+
 class TechnicalAnalyst(BaseToolSpec):
     """These tools are intended for technical analysis and investment recommendations by agents"""
     
@@ -448,4 +451,4 @@ class TechnicalAnalyst(BaseToolSpec):
 
 def get_ta_tools():
     ta = TechnicalAnalyst()
-    return ta.to_tool_list()
+    return [compact_tool(memoize_tool(tool)) for tool in ta.to_tool_list()]